@@ -0,0 +1,511 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+import httpx
+from http_pool import create_http_client
+from chat_history import estimate_tokens
+from metrics import AI_FIRST_TOKEN_SECONDS, record_tokens, record_usage, track_ai
+from resilience import (
+    AI_RETRY_ATTEMPTS, CircuitBreaker, DeadlineExceeded, ProviderUnavailable,
+    attempt_timeout, backoff, is_provider_failure, is_retryable, retry_after, time_left
+)
+
+logger = logging.getLogger(__name__)
+
+# OpenAI-совместимые провайдеры
+PROVIDERS = {
+    'deepseek': {
+        'title': 'DeepSeek API',
+        'base_url': 'https://api.deepseek.com',
+        'api_key_env': 'DEEPSEEK_API_KEY',
+        'api_key_default': 'dummy',
+        'model': 'deepseek-chat',
+    },
+    'groq': {
+        'title': 'Groq API',
+        'base_url': 'https://api.groq.com/openai/v1',
+        'api_key_env': 'GROQ_API_KEY',
+        'model': 'llama-3.3-70b-versatile',
+        'fast_model': 'llama-3.1-8b-instant',
+    },
+    'together': {
+        'title': 'Together AI',
+        'base_url': 'https://api.together.xyz/v1',
+        'api_key_env': 'TOGETHER_API_KEY',
+        'model': 'meta-llama/Llama-3-8b-chat-hf',
+        'fast_model': 'meta-llama/Llama-3.2-3B-Instruct-Turbo',
+    },
+    'huggingface': {
+        'title': 'HuggingFace API',
+        'base_url': 'https://router.huggingface.co/v1',
+        'api_key_env': 'HUGGINGFACE_API_KEY',
+        'api_key_default': 'hf_dummy',
+        'model': 'meta-llama/Llama-3.2-3B-Instruct',
+        # stream_options поддерживают не все модели роутера - токены потока оцениваются
+        'stream_usage': False,
+    },
+    'openai': {
+        'title': 'OpenAI',
+        'base_url': None,
+        'api_key_env': 'OPENAI_API_KEY',
+        'model': 'gpt-4o-mini',
+    },
+}
+
+# Дополнительные провайдеры для маршрутизации (через запятую)
+AI_EXTRA_PROVIDERS = [
+    name.strip() for name in os.getenv('AI_EXTRA_PROVIDERS', '').lower().split(',') if name.strip()
+]
+
+# Быстрая модель основного провайдера для простых запросов (пусто - из PROVIDERS,
+# у провайдеров без fast_model простые запросы идут к основной модели)
+AI_FAST_MODEL = os.getenv('AI_FAST_MODEL', '')
+
+# Через сколько секунд без ответа дублировать запрос второму провайдеру (0 - не дублировать)
+AI_HEDGE_DELAY = float(os.getenv('AI_HEDGE_DELAY', '0'))
+
+# Доля ошибок, при которой предохранитель провайдера размыкается (запросы к нему не идут)
+AI_MAX_ERROR_RATE = float(os.getenv('AI_MAX_ERROR_RATE', '0.5'))
+
+# Через сколько секунд разомкнутый предохранитель пропускает пробный запрос
+AI_PROVIDER_COOLDOWN = float(os.getenv('AI_PROVIDER_COOLDOWN', '30'))
+
+# По какому перцентилю задержки сравниваются провайдеры
+LATENCY_PERCENTILE = 0.9
+LATENCY_WINDOW = 100
+
+
+class Provider:
+    """Провайдер с клиентом и статистикой задержек и ошибок
+
+    SDK провайдера импортируется и клиент создается при первом обращении
+    (обычно при прогреве в startup), а не при загрузке модуля.
+    """
+
+    def __init__(self, name: str, http_client: httpx.AsyncClient = None, fast_model: str = None):
+        self.name = name
+        self.http_client = http_client
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.breaker = CircuitBreaker(AI_MAX_ERROR_RATE, AI_PROVIDER_COOLDOWN)
+        self._client = None
+
+        if name == 'free':
+            # Бесплатный API без регистрации (g4f)
+            self.config = None
+            self.model = "gpt-3.5-turbo"
+            self.fast_model = fast_model or self.model
+            logger.info("Используется бесплатный API (без регистрации)")
+            return
+
+        # Неизвестный провайдер - OpenAI (платный)
+        self.config = PROVIDERS.get(name, PROVIDERS['openai'])
+        self.model = self.config['model']
+        self.fast_model = fast_model or self.config.get('fast_model', self.model)
+        logger.info("Используется %s", self.config['title'])
+
+    def model_for(self, fast: bool = False) -> str:
+        return self.fast_model if fast else self.model
+
+    @property
+    def client(self):
+        if self._client is None and self.config is not None:
+            self.load()
+        return self._client
+
+    def load(self):
+        """Импорт SDK и создание клиента (можно вызывать в отдельном потоке)"""
+        if self.name == 'free':
+            import g4f
+            return
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(
+                api_key=os.getenv(self.config['api_key_env'], self.config.get('api_key_default')),
+                base_url=self.config['base_url'],
+                http_client=self.http_client,
+                # Повторы и паузы между ними - в AIEngine, с учетом дедлайна запроса
+                max_retries=0
+            )
+
+    async def probe(self) -> int:
+        """Открытие соединения и проверка доступности: HTTP статус GET /models
+
+        Любой ответ означает, что соединение установлено и останется в пуле.
+        """
+        if self.name == 'free':
+            return 0
+        client = self.client
+        response = await self.http_client.get(
+            f"{str(client.base_url).rstrip('/')}/models",
+            headers={'Authorization': f"Bearer {client.api_key}"}
+        )
+        await response.aclose()
+        return response.status_code
+
+    def latency(self) -> float:
+        """Перцентиль задержки за последние запросы (0 - еще нет данных)"""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * LATENCY_PERCENTILE))]
+
+    def healthy(self) -> bool:
+        return self.breaker.available()
+
+    def acquire(self):
+        """Разрешение предохранителя на запрос, иначе ProviderUnavailable без обращения к API"""
+        if not self.breaker.acquire():
+            raise ProviderUnavailable(
+                "AI провайдер временно недоступен", retry_after=self.breaker.reopens_in()
+            )
+
+    def record(self, latency: float = None, error: bool = False):
+        self.breaker.record(error)
+        if not error and latency is not None:
+            self.latencies.append(latency)
+
+    def record_error(self, error: Exception):
+        """Ошибка запроса: предохранитель учитывает только сбои провайдера"""
+        if is_provider_failure(error):
+            self.record(error=True)
+        else:
+            self.breaker.release()
+
+    async def chat(self, messages: list, max_tokens: int, fast: bool = False) -> str:
+        if self.name == 'free':
+            import g4f
+            return await g4f.ChatCompletion.create_async(
+                model=self.model_for(fast),
+                messages=messages
+            )
+
+        response = await self.client.chat.completions.create(
+            model=self.model_for(fast),
+            messages=messages,
+            max_tokens=max_tokens
+        )
+        record_usage(self.name, response.usage)
+        return response.choices[0].message.content
+
+
+class AIEngine:
+    """Асинхронный слой работы с AI провайдерами
+
+    Запрос уходит самому быстрому здоровому провайдеру (по перцентилю
+    задержки). Если задан AI_HEDGE_DELAY и провайдер не ответил за это
+    время (или ответил ошибкой), запрос дублируется следующему провайдеру,
+    используется первый полученный ответ.
+
+    Временные ошибки (429, 5xx, таймауты) повторяются: сразу у другого
+    провайдера или после паузы с учетом Retry-After, пока не кончится
+    дедлайн запроса (resilience.deadline). Провайдеры с разомкнутым
+    предохранителем пропускаются, если таких нет - ответ сразу.
+    """
+
+    def __init__(self, provider: str, proxy_url: str = None, extra_providers: list = AI_EXTRA_PROVIDERS):
+        self.provider = provider
+        self.providers = []
+        self.http_client = None
+
+        if provider == 'test':
+            # Тестовый режим без AI
+            self.model = "test"
+            logger.info("Используется ТЕСТОВЫЙ режим (без AI)")
+            return
+
+        self.http_client = create_http_client(proxy_url)
+        for name in [provider] + [p for p in extra_providers if p != provider]:
+            fast_model = AI_FAST_MODEL if name == provider else None
+            self.providers.append(Provider(name, self.http_client, fast_model or None))
+
+        self.model = self.providers[0].model
+
+    @property
+    def client(self):
+        return self.providers[0].client if self.providers else None
+
+    def model_for(self, fast: bool = False) -> str:
+        """Модель основного провайдера для запроса (часть ключа кэша)"""
+        return self.providers[0].model_for(fast) if self.providers else self.model
+
+    def ranked(self) -> list:
+        """Провайдеры по возрастанию задержки, нездоровые - в конце"""
+        return sorted(self.providers, key=lambda p: (not p.healthy(), p.latency()))
+
+    def available(self, failed: set = frozenset(), pool: list = None) -> list:
+        """Провайдеры с замкнутым предохранителем, сначала не ошибавшиеся в этом запросе
+
+        Пустой список - все отключены: ProviderUnavailable с временем до пробного запроса.
+        """
+        pool = self.ranked() if pool is None else pool
+        healthy = [p for p in pool if p.healthy()]
+        if not healthy:
+            raise ProviderUnavailable(
+                "AI провайдер временно недоступен, попробуйте позже",
+                retry_after=min(p.breaker.reopens_in() for p in pool)
+            )
+        return [p for p in healthy if p.name not in failed] + [p for p in healthy if p.name in failed]
+
+    def _retry_delay(self, error: Exception, attempt: int, provider: Provider, failed: set):
+        """Пауза перед следующей попыткой или None, если повторять нельзя"""
+        left = time_left()
+        if isinstance(error, asyncio.TimeoutError):
+            if left is not None and left <= 0:
+                raise DeadlineExceeded() from error
+            # Попытка не уложилась в свою долю дедлайна - провайдер завис
+            provider.record(error=True)
+        if not is_retryable(error) or attempt >= AI_RETRY_ATTEMPTS:
+            return None
+        failed.add(provider.name)
+        # Другой провайдер пробуем сразу, тот же - после паузы
+        others = [p for p in self.providers if p.name not in failed and p.healthy()]
+        delay = 0.0 if others else backoff(attempt, retry_after(error))
+        if left is not None and delay >= left:
+            return None
+        logger.info(
+            "Повтор запроса после ошибки %s через %.2f с: %s", provider.name, delay, error,
+            extra={'provider': provider.name}
+        )
+        return delay
+
+    async def _retrying(self, call, pool: list = None, failed: set = None):
+        """call(провайдер) с повторами временных ошибок в пределах дедлайна
+
+        failed - имена провайдеров с ошибкой в этом запросе (общие с call,
+        если тот сам обращается к нескольким провайдерам).
+        """
+        failed = set() if failed is None else failed
+        for attempt in range(1, AI_RETRY_ATTEMPTS + 1):
+            provider = self.available(failed, pool)[0]
+            timeout = attempt_timeout(AI_RETRY_ATTEMPTS - attempt + 1)
+            try:
+                if timeout is None:
+                    return await call(provider)
+                return await asyncio.wait_for(call(provider), timeout)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, provider, failed)
+                if delay is None:
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise DeadlineExceeded() from e
+                    raise
+                await asyncio.sleep(delay)
+
+    async def _timed_chat(self, provider: Provider, messages: list, max_tokens: int, fast: bool = False) -> str:
+        provider.acquire()
+        started = time.monotonic()
+        try:
+            with track_ai(provider.name, 'chat'):
+                answer = await provider.chat(messages, max_tokens, fast)
+        except asyncio.CancelledError:
+            # Проигравший дублирующий запрос (или таймаут попытки): провайдер
+            # был как минимум настолько медленным
+            provider.latencies.append(time.monotonic() - started)
+            provider.breaker.release()
+            raise
+        except Exception as e:
+            provider.record_error(e)
+            logger.warning(
+                "Ошибка провайдера %s: %s", provider.name, e,
+                extra={'provider': provider.name, 'latency': round(time.monotonic() - started, 3)}
+            )
+            raise
+        latency = time.monotonic() - started
+        provider.record(latency=latency)
+        logger.debug("Ответ %s за %.2f с", provider.name, latency,
+                     extra={'provider': provider.name, 'latency': round(latency, 3)})
+        return answer
+
+    async def chat(self, messages: list, max_tokens: int, fast: bool = False) -> str:
+        """Запрос к чат-модели, возвращает текст ответа (fast - быстрая модель провайдера)"""
+        failed = set()
+        return await self._retrying(
+            lambda provider: self._hedged_chat(provider, failed, messages, max_tokens, fast), failed=failed
+        )
+
+    async def _hedged_chat(self, provider: Provider, failed: set, messages: list, max_tokens: int,
+                           fast: bool) -> str:
+        ranked = [provider] + [p for p in self.available(failed) if p is not provider]
+        hedges = ranked[1:2] if AI_HEDGE_DELAY > 0 else []
+        tasks = [asyncio.ensure_future(self._timed_chat(ranked[0], messages, max_tokens, fast))]
+        owners = {tasks[0]: ranked[0]}
+        error = None
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks,
+                    timeout=AI_HEDGE_DELAY if hedges else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                    # Провайдер основной попытки отметит _retrying, дублирующий - здесь
+                    if owners[task] is not provider and is_retryable(error):
+                        failed.add(owners[task].name)
+                # Нет ответа за AI_HEDGE_DELAY или ошибка - дублируем запрос
+                if hedges:
+                    hedge = hedges.pop(0)
+                    logger.info("Дублирующий запрос к %s", hedge.name, extra={'provider': hedge.name})
+                    tasks.append(asyncio.ensure_future(self._timed_chat(hedge, messages, max_tokens, fast)))
+                    owners[tasks[-1]] = hedge
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream_chat(self, messages: list, max_tokens: int, fast: bool = False):
+        """Потоковый запрос к чат-модели, отдает текст по частям
+
+        Повтор возможен, пока пользователю не ушло ни одной части ответа.
+        """
+        failed = set()
+        for attempt in range(1, AI_RETRY_ATTEMPTS + 1):
+            provider = self.available(failed)[0]
+            if provider.name == 'free':
+                # g4f не поддерживает потоковый режим - отдаем ответ целиком
+                yield await self._retrying(lambda p: self._timed_chat(p, messages, max_tokens, fast), failed=failed)
+                return
+
+            sent = False
+            stream = self._stream_once(
+                provider, messages, max_tokens, fast, attempt_timeout(AI_RETRY_ATTEMPTS - attempt + 1)
+            )
+            try:
+                async for text in stream:
+                    sent = True
+                    yield text
+                return
+            except Exception as e:
+                delay = None if sent else self._retry_delay(e, attempt, provider, failed)
+                if delay is None:
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise DeadlineExceeded() from e
+                    raise
+                await asyncio.sleep(delay)
+            finally:
+                await stream.aclose()
+
+    async def _stream_once(self, provider: Provider, messages: list, max_tokens: int, fast: bool,
+                           first_timeout: float = None):
+        """Одна попытка потокового запроса: первая часть - за first_timeout, весь ответ - до дедлайна"""
+        provider.acquire()
+        started = time.monotonic()
+        with track_ai(provider.name, 'stream'):
+            stream = None
+            try:
+                stream_usage = provider.config.get('stream_usage', True)
+                stream = await asyncio.wait_for(provider.client.chat.completions.create(
+                    model=provider.model_for(fast),
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    stream=True,
+                    # Последний фрагмент потока - с usage (через extra_body: поле есть не во всех версиях SDK)
+                    extra_body={'stream_options': {'include_usage': True}} if stream_usage else None
+                ), first_timeout)
+                chunks = stream.__aiter__()
+                first = True
+                usage = None
+                parts = []
+                while True:
+                    left = time_left()
+                    timeout = first_timeout - (time.monotonic() - started) if first and first_timeout else left
+                    try:
+                        chunk = await asyncio.wait_for(
+                            chunks.__anext__(), None if timeout is None else max(timeout, 0)
+                        )
+                    except StopAsyncIteration:
+                        break
+                    if getattr(chunk, 'usage', None):
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first:
+                            AI_FIRST_TOKEN_SECONDS.observe(time.monotonic() - started, provider=provider.name)
+                            first = False
+                        parts.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+                provider.record()
+                if usage is not None:
+                    record_usage(provider.name, usage)
+                else:
+                    # Провайдер не прислал usage - оценка по длине текста
+                    record_tokens(
+                        provider.name,
+                        sum(estimate_tokens(m['content']) for m in messages),
+                        estimate_tokens(''.join(parts))
+                    )
+            except (asyncio.CancelledError, GeneratorExit):
+                provider.breaker.release()
+                raise
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    # Таймаут попытки учтет _retry_delay - как и для обычных запросов
+                    provider.breaker.release()
+                else:
+                    provider.record_error(e)
+                logger.warning(
+                    "Ошибка провайдера %s: %s", provider.name, e,
+                    extra={'provider': provider.name, 'latency': round(time.monotonic() - started, 3)}
+                )
+                raise
+            finally:
+                if stream is not None:
+                    await stream.response.aclose()
+
+    async def generate_image(self, prompt: str, size: str = "1024x1024", quality: str = "standard") -> str:
+        """Генерация изображения (DALL-E), возвращает URL"""
+        provider = next((p for p in self.providers if p.name == 'openai'), self.providers[0])
+
+        async def generate(provider: Provider) -> str:
+            provider.acquire()
+            try:
+                with track_ai(provider.name, 'image'):
+                    response = await provider.client.images.generate(
+                        model="dall-e-3",
+                        prompt=prompt,
+                        size=size,
+                        quality=quality,
+                        n=1
+                    )
+            except asyncio.CancelledError:
+                provider.breaker.release()
+                raise
+            except Exception as e:
+                provider.record_error(e)
+                raise
+            provider.record()
+            return response.data[0].url
+
+        return await self._retrying(generate, pool=[provider])
+
+    async def warm_up(self, timeout: float) -> dict:
+        """Параллельный прогрев провайдеров: импорт SDK, соединение, проверка
+
+        Возвращает {провайдер: (секунды, HTTP статус или ошибка)}.
+        """
+        async def warm(provider: Provider):
+            started = time.monotonic()
+            try:
+                # Импорт SDK блокирует - выносим в поток, пока идут другие проверки
+                await asyncio.to_thread(provider.load)
+                status = await asyncio.wait_for(provider.probe(), timeout)
+            except Exception as e:
+                provider.record(error=True)
+                return provider.name, (time.monotonic() - started, f"{type(e).__name__}: {e}")
+            return provider.name, (time.monotonic() - started, status)
+
+        return dict(await asyncio.gather(*[warm(p) for p in self.providers]))
+
+    async def fetch(self, url: str) -> bytes:
+        """Загрузка файла (например, готового изображения) через общий пул соединений"""
+        response = await self.http_client.get(url)
+        response.raise_for_status()
+        return response.content
+
+    async def aclose(self):
+        """Закрытие HTTP соединений"""
+        if self.http_client is not None:
+            await self.http_client.aclose()
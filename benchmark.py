@@ -0,0 +1,490 @@
+"""Нагрузочный тест бота без сети
+
+Запускает локальный OpenAI-совместимый сервер с заданным распределением
+задержек, потоковыми ответами и ошибками, подменяет Bot API заглушкой и
+подает синтетические обновления в настоящие обработчики бота.
+
+Пример:
+    python benchmark.py --rate 20 --duration 30 --users 200 --error-rate 0.05
+"""
+import os
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+import importlib
+from collections import defaultdict, deque
+from telegram import Update
+from telegram.request import BaseRequest
+
+logger = logging.getLogger('benchmark')
+
+# Режимы, которые можно нагружать, и их доля по умолчанию
+DEFAULT_MIX = 'chat=50,translate=20,summary=15,ideas=10,image=5'
+
+# Тексты сообщений по режимам
+TEXTS = {
+    'chat': ["Как работает асинхронность в Python?", "Что почитать про распределенные системы?",
+             "Объясни разницу между процессом и потоком", "Как ускорить SQL запрос?"],
+    'translate': ["английский: Привет, как дела?", "немецкий: Сегодня хорошая погода",
+                  "французский: Где находится вокзал?", "английский, немецкий, испанский: Спасибо за помощь"],
+    'summary': ["Асинхронное программирование позволяет обрабатывать много запросов одновременно. " * 20,
+                "Кэширование снижает задержку и нагрузку на внешние сервисы. " * 40],
+    'ideas': ["подарок на день рождения", "название для кофейни", "хобби на выходные"],
+    'image': ["кот в космосе", "закат над морем", "город будущего"],
+}
+
+# Прозрачный PNG 1x1 - ответ на загрузку сгенерированного изображения
+PNG_1X1 = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082'
+)
+
+# Имя быстрой модели в тесте: ее ответы в fast_speedup раз быстрее
+FAST_MODEL = 'bench-fast'
+
+WORDS = ('асинхронный', 'ответ', 'модели', 'для', 'проверки', 'нагрузки', 'бота', 'и', 'очереди', 'запросов')
+
+
+def percentile(values: list, q: float) -> float:
+    """Перцентиль по ближайшему рангу (values отсортирован)"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for item in mix.split(','):
+        mode, _, weight = item.partition('=')
+        mode = mode.strip()
+        if mode not in TEXTS:
+            raise ValueError(f"Неизвестный режим: {mode}")
+        weights[mode] = float(weight or 1)
+    return weights
+
+
+class SimulatedProvider:
+    """Локальный OpenAI-совместимый сервер (chat/completions, images/generations)
+
+    Задержка до первого токена - логнормальная с медианой latency и разбросом
+    sigma, дальше по token_delay на токен. Доля error_rate запросов получает
+    500, доля throttle_rate - 429 с Retry-After. Быстрая модель (FAST_MODEL)
+    отвечает в fast_speedup раз быстрее.
+    """
+
+    def __init__(self, latency: float = 0.5, sigma: float = 0.5, token_delay: float = 0.02,
+                 tokens: int = 60, error_rate: float = 0.0, throttle_rate: float = 0.0,
+                 fast_speedup: float = 3.0):
+        self.latency = latency
+        self.sigma = sigma
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.fast_speedup = fast_speedup
+        self.server = None
+        self.port = None
+        self.stats = defaultdict(int)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _delay(self, speedup: float = 1.0) -> float:
+        if self.sigma <= 0:
+            return self.latency / speedup
+        return random.lognormvariate(math.log(self.latency), self.sigma) / speedup
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Соединения keep-alive: несколько запросов подряд
+            while request_line := await reader.readline():
+                method, path = request_line.decode('latin-1').split()[:2]
+                headers = {}
+                while (line := await reader.readline()).strip():
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', '0')))
+                await self._respond(writer, method, path, body)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _write(self, writer, status: str, body: bytes, content_type: str = 'application/json', headers: dict = None):
+        head = f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+        for name, value in (headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+
+    async def _respond(self, writer, method: str, path: str, body: bytes):
+        path = path.split('?')[0]
+        if method == 'GET' and path.startswith('/files/'):
+            self.stats['files'] += 1
+            self._write(writer, '200 OK', PNG_1X1, 'image/png')
+            await writer.drain()
+            return
+
+        if method == 'GET' and path.endswith('/models'):
+            # Проверка доступности при прогреве соединений
+            self._write(writer, '200 OK', json.dumps({'object': 'list', 'data': [{'id': 'simulated'}]}).encode())
+            await writer.drain()
+            return
+
+        self.stats['requests'] += 1
+        roll = random.random()
+        if roll < self.error_rate:
+            self.stats['errors'] += 1
+            await asyncio.sleep(self._delay())
+            self._write(writer, '500 Internal Server Error',
+                        json.dumps({'error': {'message': 'simulated failure', 'type': 'server_error'}}).encode())
+            await writer.drain()
+            return
+        if roll < self.error_rate + self.throttle_rate:
+            self.stats['throttled'] += 1
+            self._write(writer, '429 Too Many Requests',
+                        json.dumps({'error': {'message': 'simulated rate limit', 'type': 'rate_limit'}}).encode(),
+                        headers={'Retry-After': '1'})
+            await writer.drain()
+            return
+
+        payload = json.loads(body or b'{}')
+        if path.endswith('/images/generations'):
+            self.stats['images'] += 1
+            await asyncio.sleep(self._delay())
+            data = {'created': int(time.time()), 'data': [{'url': f"http://127.0.0.1:{self.port}/files/image.png"}]}
+            self._write(writer, '200 OK', json.dumps(data).encode())
+        elif path.endswith('/chat/completions'):
+            await self._chat(writer, payload)
+        else:
+            self._write(writer, '404 Not Found', b'{"error": {"message": "not found"}}')
+        await writer.drain()
+
+    async def _chat(self, writer, payload: dict):
+        tokens = min(self.tokens, payload.get('max_tokens') or self.tokens)
+        words = [random.choice(WORDS) for _ in range(tokens)]
+        # Запрос ответа в JSON (перевод на несколько языков) - отвечаем JSON с теми же ключами
+        prompt = str(payload.get('messages', [{}])[-1].get('content', ''))
+        keys = re.findall(r'"([^"]+)": "\.\.\."', prompt)
+        if keys:
+            words = [json.dumps({key: ' '.join(words[:10]) for key in keys}, ensure_ascii=False)]
+        prompt_tokens = sum(len(str(m.get('content', ''))) for m in payload.get('messages', [])) // 4 + 1
+        model = payload.get('model', 'simulated')
+        speedup = self.fast_speedup if model == FAST_MODEL else 1.0
+        self.stats['fast' if model == FAST_MODEL else 'main'] += 1
+        created = int(time.time())
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': tokens, 'total_tokens': prompt_tokens + tokens}
+
+        if not payload.get('stream'):
+            self.stats['completions'] += 1
+            await asyncio.sleep(self._delay(speedup) + tokens * self.token_delay / speedup)
+            data = {
+                'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ' '.join(words)},
+                             'finish_reason': 'stop'}],
+                'usage': usage,
+            }
+            self._write(writer, '200 OK', json.dumps(data, ensure_ascii=False).encode('utf-8'))
+            return
+
+        # Потоковый ответ: Server-Sent Events в chunked-кодировании
+        self.stats['streams'] += 1
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        await asyncio.sleep(self._delay(speedup))
+
+        def event(delta: dict, finish_reason=None) -> bytes:
+            chunk = {
+                'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }
+            data = f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8')
+            return f"{len(data):x}\r\n".encode() + data + b"\r\n"
+
+        writer.write(event({'role': 'assistant', 'content': ''}))
+        for word in words:
+            writer.write(event({'content': word + ' '}))
+            await writer.drain()
+            await asyncio.sleep(self.token_delay / speedup)
+        writer.write(event({}, 'stop'))
+        if (payload.get('stream_options') or {}).get('include_usage'):
+            # Как у OpenAI: последний фрагмент без choices, с usage
+            chunk = {'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': created,
+                     'model': model, 'choices': [], 'usage': usage}
+            data = f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8')
+            writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        done = b"data: [DONE]\n\n"
+        writer.write(f"{len(done):x}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+
+
+class FakeBotAPI(BaseRequest):
+    """Bot API без сети: отвечает на любые методы и считает вызовы"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.message_id = 0
+        self.calls = defaultdict(int)
+        self.results = defaultdict(deque)
+
+    def expect_result(self, chat_id: int) -> asyncio.Future:
+        """Ожидание итогового сообщения в чат: фото или ошибки (для фоновых заданий)"""
+        future = asyncio.get_running_loop().create_future()
+        self.results[chat_id].append(future)
+        return future
+
+    def _deliver(self, chat_id: int):
+        waiters = self.results.get(chat_id)
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        parameters = request_data.parameters if request_data is not None else {}
+
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif endpoint.startswith(('send', 'edit')) and 'chat_id' in parameters:
+            chat_id = int(parameters['chat_id'])
+            text = parameters.get('text') or parameters.get('caption') or ''
+            self.message_id += 1
+            result = {
+                'message_id': parameters.get('message_id', self.message_id),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': text,
+            }
+            if endpoint == 'sendPhoto':
+                # Повторная отправка по file_id возвращает тот же file_id
+                photo = parameters.get('photo')
+                file_id = photo if isinstance(photo, str) else f"photo-{self.message_id}"
+                result['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1, 'height': 1}]
+            if endpoint == 'sendPhoto' or text.startswith(('❌', '⏳ ')):
+                self._deliver(chat_id)
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+
+class LoadGenerator:
+    """Синтетические обновления Telegram и замер времени их обработки"""
+
+    def __init__(self, application, bot_api: FakeBotAPI, users: int, mix: dict, repeat: float = 0.3):
+        self.application = application
+        self.bot_api = bot_api
+        self.repeat = repeat
+        self.update_id = 0
+        self.message_id = 0
+        modes = list(mix)
+        weights = [mix[mode] for mode in modes]
+        # У каждого пользователя свой режим, доли режимов - по mix
+        self.users = {100000 + i: random.choices(modes, weights)[0] for i in range(users)}
+        self.latencies = defaultdict(list)
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        self.message_id += 1
+        data = {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            data['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return data
+
+    def _update(self, **payload) -> Update:
+        self.update_id += 1
+        return Update.de_json({'update_id': self.update_id, **payload}, self.application.bot)
+
+    async def prepare(self):
+        """/start и выбор режима каждым пользователем - через обычные обработчики"""
+        async def choose(user_id: int, mode: str):
+            await self.application.process_update(self._update(message=self._message(user_id, '/start')))
+            await self.application.process_update(self._update(callback_query={
+                'id': str(user_id),
+                'from': self._user(user_id),
+                'chat_instance': 'bench',
+                'data': f'mode_{mode}',
+                'message': self._message(user_id, 'menu'),
+            }))
+
+        await asyncio.gather(*[choose(user_id, mode) for user_id, mode in self.users.items()])
+
+    def _text(self, mode: str) -> str:
+        text = random.choice(TEXTS[mode])
+        # Часть запросов повторяется дословно (попадания в кэш), остальные уникальны
+        if random.random() >= self.repeat:
+            text = f"{text} #{random.randrange(10 ** 9)}"
+        return text
+
+    async def _send(self, user_id: int):
+        mode = self.users[user_id]
+        update = self._update(message=self._message(user_id, self._text(mode)))
+        delivered = self.bot_api.expect_result(user_id) if mode == 'image' else None
+        started = time.monotonic()
+        await self.application.process_update(update)
+        if delivered is not None:
+            # Изображение генерируется в фоне - ждем отправки фото
+            await delivered
+        self.latencies[mode].append(time.monotonic() - started)
+
+    async def run(self, rate: float, duration: float, drain_timeout: float = 120) -> float:
+        """Пуассоновский поток сообщений rate в секунду в течение duration секунд"""
+        tasks = set()
+        user_ids = list(self.users)
+        started = time.monotonic()
+        deadline = started + duration
+        while time.monotonic() < deadline:
+            task = asyncio.create_task(self._send(random.choice(user_ids)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            await asyncio.sleep(random.expovariate(rate))
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning("Не дождались %d сообщений", len(pending))
+        return time.monotonic() - started
+
+
+def report(generator: LoadGenerator, bot_api: FakeBotAPI, provider: SimulatedProvider, elapsed: float) -> str:
+    """Таблица: количество, пропускная способность, ошибки и перцентили по режимам"""
+    # Ошибки (включая отказы по лимитам) - из метрик бота; отмененные новым
+    # сообщением ответы считаются отдельно
+    from metrics import ERRORS
+    failures = defaultdict(int)
+    superseded = 0
+    for (mode, error), count in ERRORS.values.items():
+        if error == 'Superseded':
+            superseded += count
+        else:
+            failures[mode] += count
+
+    lines = [f"{'режим':<10} {'сообщ.':>7} {'в сек':>7} {'ошибки':>7} {'p50':>7} {'p95':>7} {'p99':>7} {'max':>7}"]
+    total = 0
+    for mode in sorted(generator.latencies):
+        values = sorted(generator.latencies[mode])
+        total += len(values)
+        lines.append(
+            f"{mode:<10} {len(values):>7} {len(values) / elapsed:>7.2f} {failures[mode]:>7} "
+            f"{percentile(values, 0.5):>7.3f} {percentile(values, 0.95):>7.3f} "
+            f"{percentile(values, 0.99):>7.3f} {values[-1]:>7.3f}"
+        )
+    lines.append(f"Всего: {total} сообщений за {elapsed:.1f} с ({total / elapsed:.2f} в сек), отменено: {superseded}")
+    lines.append(
+        "Провайдер: " + ', '.join(f"{name}={count}" for name, count in sorted(provider.stats.items()))
+    )
+    lines.append(
+        "Bot API: " + ', '.join(f"{name}={count}" for name, count in sorted(bot_api.calls.items()))
+    )
+    return '\n'.join(lines)
+
+
+async def benchmark(args) -> str:
+    provider = SimulatedProvider(
+        latency=args.latency, sigma=args.sigma, token_delay=args.token_delay, tokens=args.tokens,
+        error_rate=args.error_rate, throttle_rate=args.throttle_rate, fast_speedup=args.fast_speedup
+    )
+    await provider.start()
+
+    # Настройки читаются при импорте модулей - задаем их до импорта бота
+    os.environ.update({
+        'AI_PROVIDER': 'openai',
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': provider.base_url,
+        'AI_EXTRA_PROVIDERS': '',
+        'AI_FAST_MODEL': FAST_MODEL,
+        'PROXY_URL': '',
+        'BOT_MODE': 'polling',
+        'SHARD_WORKERS': '1',
+    })
+    os.environ.setdefault('SESSION_BACKEND', 'memory')
+    os.environ.setdefault('CACHE_DB_PATH', '')
+    os.environ.setdefault('USER_RATE', '1000')
+    os.environ.setdefault('USER_BURST', '1000')
+    os.environ.setdefault('USER_MAX_QUEUED', '1000')
+    module = importlib.import_module(args.bot)
+    logging.getLogger().setLevel(args.log_level)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    bot_api = FakeBotAPI(args.telegram_latency)
+    application = module.build_application('123456:BENCHMARK', request=bot_api)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        generator = LoadGenerator(application, bot_api, args.users, parse_mix(args.mix), args.repeat)
+        await generator.prepare()
+        print(f"Нагрузка: {args.rate} сообщ./с, {args.duration} с, {args.users} пользователей ({args.bot})")
+        elapsed = await generator.run(args.rate, args.duration)
+        return report(generator, bot_api, provider, elapsed)
+    finally:
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        await provider.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с имитацией AI провайдера")
+    parser.add_argument('--bot', default='bot_v2', help="модуль бота (bot или bot_v2)")
+    parser.add_argument('--rate', type=float, default=10, help="сообщений в секунду")
+    parser.add_argument('--duration', type=float, default=20, help="длительность нагрузки, с")
+    parser.add_argument('--users', type=int, default=100, help="количество пользователей")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="доли режимов, например chat=50,translate=20")
+    parser.add_argument('--repeat', type=float, default=0.3, help="доля дословно повторяющихся запросов")
+    parser.add_argument('--latency', type=float, default=0.5, help="медиана задержки провайдера, с")
+    parser.add_argument('--sigma', type=float, default=0.5, help="разброс задержки (логнормальное, 0 - постоянная)")
+    parser.add_argument('--token-delay', type=float, default=0.02, help="задержка на токен, с")
+    parser.add_argument('--tokens', type=int, default=60, help="токенов в ответе")
+    parser.add_argument('--fast-speedup', type=float, default=3.0, help="во сколько раз быстрее быстрая модель")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help="задержка Bot API, с")
+    parser.add_argument('--seed', type=int, default=None, help="seed для воспроизводимости")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=args.log_level)
+    if args.seed is not None:
+        random.seed(args.seed)
+    print(asyncio.run(benchmark(args)))
+
+
+if __name__ == '__main__':
+    main()
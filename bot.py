@@ -1,19 +1,42 @@
+import time
+# Отсчет времени запуска - до импорта остальных модулей
+STARTED = time.perf_counter()
 import os
+import asyncio
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from openai import OpenAI
+from telegram.error import BadRequest
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, ContextTypes, filters
 from dotenv import load_dotenv
-import httpx
+from ai_engine import AIEngine
+from http_pool import telegram_request
+import launcher
+import sharding
+from sharding import SHARD_WORKERS
+from outbox import OutboxRateLimiter, send_answer
+from streaming import STREAM_RESPONSES, stream_to_message
+from response_cache import ResponseCache
+from image_jobs import ImageJobs
+from translation import build_prompt, plan_translation, split_translations
+from tiering import chat_tier, count_tier, counted, ideas_tier, summary_tier, translate_tier
+from session_store import SessionStore
+from scheduler import FairScheduler, RateLimited
+from user_lanes import CANCEL_ON_NEW_MESSAGE, Superseded, UserLanes
+from documents import DocumentError, is_long_text, read_document, summarize_long
+from resilience import deadline
+from log_pipeline import log_context, setup_logging
+from metrics import ACTIVE_SESSIONS, start_metrics_server, track_request
+from chat_history import append_message, build_messages, compact_history, reset_history
+from warmup import StartupTimer, warm_up
+
+# Время этапов запуска (пишется в лог после прогрева соединений)
+startup_timer = StartupTimer(STARTED)
 
 # Загрузка переменных окружения
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Настройка логирования: записи пишет фоновый поток, цикл событий не ждет stderr
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Выбор AI провайдера
@@ -22,87 +45,33 @@ AI_PROVIDER = os.getenv('AI_PROVIDER', 'deepseek').lower()
 # Инициализация клиента в зависимости от провайдера
 proxy_url = os.getenv('PROXY_URL')
 
-if AI_PROVIDER == 'test':
-    # Тестовый режим без AI
-    client = None
-    AI_MODEL = "test"
-    logger.info("Используется ТЕСТОВЫЙ режим (без AI)")
-
-elif AI_PROVIDER == 'free':
-    # Бесплатный API без регистрации (g4f)
-    import g4f
-    client = None
-    AI_MODEL = "gpt-3.5-turbo"
-    logger.info("Используется бесплатный API (без регистрации)")
-
-elif AI_PROVIDER == 'huggingface':
-    # HuggingFace API (бесплатный)
-    client = OpenAI(
-        api_key=os.getenv('HUGGINGFACE_API_KEY', 'hf_dummy'),
-        base_url="https://router.huggingface.co/v1"
-    )
-    AI_MODEL = "meta-llama/Llama-3.2-3B-Instruct"
-    logger.info("Используется HuggingFace API")
-
-elif AI_PROVIDER == 'together':
-    # Together AI (бесплатный)
-    client = OpenAI(
-        api_key=os.getenv('TOGETHER_API_KEY'),
-        base_url="https://api.together.xyz/v1"
-    )
-    AI_MODEL = "meta-llama/Llama-3-8b-chat-hf"
-    logger.info("Используется Together AI")
-    
-elif AI_PROVIDER == 'deepseek':
-    # DeepSeek API (бесплатный)
-    if proxy_url:
-        http_client = httpx.Client(proxy=proxy_url)
-        client = OpenAI(
-            api_key=os.getenv('DEEPSEEK_API_KEY', 'dummy'),
-            base_url="https://api.deepseek.com",
-            http_client=http_client
-        )
-    else:
-        client = OpenAI(
-            api_key=os.getenv('DEEPSEEK_API_KEY', 'dummy'),
-            base_url="https://api.deepseek.com"
-        )
-    AI_MODEL = "deepseek-chat"
-    logger.info(f"Используется DeepSeek API")
-    
-elif AI_PROVIDER == 'groq':
-    # Groq API (бесплатный, очень быстрый)
-    if proxy_url:
-        http_client = httpx.Client(proxy=proxy_url)
-        client = OpenAI(
-            api_key=os.getenv('GROQ_API_KEY'),
-            base_url="https://api.groq.com/openai/v1",
-            http_client=http_client
-        )
-    else:
-        client = OpenAI(
-            api_key=os.getenv('GROQ_API_KEY'),
-            base_url="https://api.groq.com/openai/v1"
-        )
-    AI_MODEL = "llama-3.3-70b-versatile"
-    logger.info(f"Используется Groq API")
-    
-else:
-    # OpenAI (платный)
-    if proxy_url:
-        http_client = httpx.Client(proxy=proxy_url)
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=http_client)
-        logger.info(f"Используется OpenAI с прокси: {proxy_url}")
-    else:
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        logger.info("Используется OpenAI")
-    AI_MODEL = "gpt-4o-mini"
+engine = AIEngine(AI_PROVIDER, proxy_url)
+AI_MODEL = engine.model
 
 if proxy_url:
-    logger.info(f"Прокси: {proxy_url}")
+    logger.info("Прокси: %s", proxy_url)
+
+# Кэш ответов для перевода, резюме и идей
+response_cache = ResponseCache()
+
+# Генерация изображений в фоне (очередь, file_id готовых изображений)
+image_jobs = ImageJobs(engine)
+
+# Допуск запросов к AI (лимиты пользователей, справедливая очередь)
+scheduler = FairScheduler()
+
+# Сообщения каждого пользователя - по очереди, устаревшие запросы отменяются
+lanes = UserLanes()
+
+# HTTP сервер /metrics (запускается в startup)
+metrics_server = None
+
+# Количество одновременно обрабатываемых обновлений
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '256'))
 
 # Хранилище контекста пользователей
-user_contexts = {}
+user_contexts = SessionStore(in_use=lanes.active)
+ACTIVE_SESSIONS.set_function(lambda: len(user_contexts.sessions))
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start - приветствие и меню"""
@@ -135,6 +104,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user_id = query.from_user.id
     
+    # Смена режима: ответ в старом режиме уже не нужен
+    if query.data.startswith('mode_'):
+        lanes.cancel(user_id)
+    
     if query.data == 'mode_chat':
         user_contexts[user_id] = {'mode': 'chat', 'history': []}
         await query.edit_message_text(
@@ -221,20 +194,64 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     mode = user_contexts[user_id]['mode']
     
     try:
-        if mode == 'chat':
-            await handle_chat(update, user_id, user_message)
-        elif mode == 'image':
-            await handle_image_generation(update, user_message)
-        elif mode == 'translate':
-            await handle_translate(update, user_id, user_message)
-        elif mode == 'summary':
-            await handle_summary(update, user_id, user_message)
-        elif mode == 'ideas':
-            await handle_ideas(update, user_id, user_message)
-        elif mode == 'video':
-            await handle_video_generation(update, user_message)
+        # Дедлайн на все запросы к AI по сообщению, вместе с очередью и повторами
+        with track_request(mode), deadline(mode), log_context(user_id=user_id, mode=mode):
+            # Новое сообщение в режимах CANCEL_ON_NEW_MESSAGE отменяет ответ на предыдущее
+            async with lanes.lane(user_id, supersede=mode in CANCEL_ON_NEW_MESSAGE):
+                # Очередь к AI: лимит запросов пользователя и общий лимит параллельных запросов
+                async with scheduler.slot(user_id, mode):
+                    if mode == 'chat':
+                        await handle_chat(update, user_id, user_message)
+                    elif mode == 'image':
+                        await handle_image_generation(update, user_message)
+                    elif mode == 'translate':
+                        await handle_translate(update, user_id, user_message)
+                    elif mode == 'summary':
+                        await handle_summary(update, user_id, user_message)
+                    elif mode == 'ideas':
+                        await handle_ideas(update, user_id, user_message)
+                    elif mode == 'video':
+                        await handle_video_generation(update, user_message)
+    except Superseded:
+        # Пользователь уже сменил режим или прислал новое сообщение
+        pass
+    except RateLimited as e:
+        wait = f" Попробуйте через {max(1, round(e.retry_after))} с." if e.retry_after else ""
+        await update.message.reply_text(f"⏳ {e}.{wait}")
+    except Exception as e:
+        logger.error("Error: %s", e, extra={'user_id': user_id, 'mode': mode})
+        await update.message.reply_text(
+            f"❌ Произошла ошибка: {str(e)}\n\n"
+            "Попробуйте еще раз или используйте /menu для смены режима"
+        )
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Прием документов (.txt, .md, .html) для резюме"""
+    user_id = update.message.from_user.id
+    
+    if user_id not in user_contexts or user_contexts[user_id].get('mode') != 'summary':
+        await update.message.reply_text(
+            "📄 Документы принимаются в режиме «Резюме текста»\n\n"
+            "Используйте /menu для смены режима"
+        )
+        return
+    
+    try:
+        with track_request('summary'), deadline('summary'), log_context(user_id=user_id, mode='summary'):
+            async with lanes.lane(user_id, supersede='summary' in CANCEL_ON_NEW_MESSAGE):
+                async with scheduler.slot(user_id, 'summary'):
+                    await update.message.reply_text("📄 Читаю документ...")
+                    text = await read_document(update.message.document, engine.http_client)
+                    await handle_summary(update, user_id, text)
+    except DocumentError as e:
+        await update.message.reply_text(f"⚠️ {e}")
+    except Superseded:
+        pass
+    except RateLimited as e:
+        wait = f" Попробуйте через {max(1, round(e.retry_after))} с." if e.retry_after else ""
+        await update.message.reply_text(f"⏳ {e}.{wait}")
     except Exception as e:
-        logger.error(f"Error: {e}")
+        logger.error("Error: %s", e, extra={'user_id': user_id, 'mode': 'summary'})
         await update.message.reply_text(
             f"❌ Произошла ошибка: {str(e)}\n\n"
             "Попробуйте еще раз или используйте /menu для смены режима"
@@ -256,37 +273,44 @@ async def handle_chat(update: Update, user_id: int, message: str):
         )
         return
     
-    # Добавление сообщения в историю
-    if 'history' not in user_contexts[user_id]:
-        user_contexts[user_id]['history'] = []
+    session = user_contexts[user_id]
     
-    user_contexts[user_id]['history'].append({
-        "role": "user",
-        "content": message
-    })
-    
-    # Ограничение истории (последние 10 сообщений)
-    if len(user_contexts[user_id]['history']) > 20:
-        user_contexts[user_id]['history'] = user_contexts[user_id]['history'][-20:]
+    # Добавление сообщения в историю
+    append_message(session, "user", message)
     
     # Отправка запроса к OpenAI
-    await update.message.reply_text("⏳ Думаю...")
-    
-    response = client.chat.completions.create(
-        model=AI_MODEL,
-        messages=user_contexts[user_id]['history'],
-        max_tokens=1000
-    )
+    placeholder = await update.message.reply_text("⏳ Думаю...")
     
-    assistant_message = response.choices[0].message.content
+    try:
+        # Ограничение истории по бюджету токенов (старое сжимается в краткое содержание)
+        await compact_history(session, engine.chat)
+        messages = build_messages(session)
+        # Простые вопросы - быстрой модели и с меньшим лимитом ответа
+        tier = chat_tier(messages)
+        count_tier('chat', tier)
+    
+        if STREAM_RESPONSES:
+            # Ответ появляется в сообщении-заглушке по мере генерации
+            assistant_message = await stream_to_message(
+                placeholder,
+                engine.stream_chat(messages, max_tokens=tier.max_tokens, fast=tier.fast)
+            )
+        else:
+            assistant_message = await engine.chat(messages, max_tokens=tier.max_tokens, fast=tier.fast)
+            await send_answer(update.message, assistant_message, placeholder)
+    except asyncio.CancelledError:
+        # Ответ больше не нужен: новое сообщение, смена режима или /clear
+        try:
+            await placeholder.edit_text("⏹ Ответ отменен")
+        except BadRequest:
+            pass
+        raise
     
     # Добавление ответа в историю
-    user_contexts[user_id]['history'].append({
-        "role": "assistant",
-        "content": assistant_message
-    })
+    append_message(session, "assistant", assistant_message)
     
-    await update.message.reply_text(assistant_message)
+    # Сжатие заранее, пока пользователь читает ответ
+    await compact_history(session, engine.chat)
 
 async def handle_image_generation(update: Update, prompt: str):
     """Генерация изображения (DALL-E)"""
@@ -300,22 +324,14 @@ async def handle_image_generation(update: Update, prompt: str):
         )
         return
     
-    await update.message.reply_text("🎨 Генерирую изображение...")
-    
-    response = client.images.generate(
-        model="dall-e-3",
-        prompt=prompt,
-        size="1024x1024",
-        quality="standard",
-        n=1
-    )
+    caption = f"🖼️ Ваше изображение готово!\n\nЗапрос: {prompt}"
     
-    image_url = response.data[0].url
+    # Такое изображение уже было - отправляем сохраненное без генерации
+    if await image_jobs.send_cached(update.message, prompt, caption):
+        return
     
-    await update.message.reply_photo(
-        photo=image_url,
-        caption=f"🖼️ Ваше изображение готово!\n\nЗапрос: {prompt}"
-    )
+    # Генерация идет в фоне, пользователь видит место в очереди
+    await image_jobs.submit(update.message.from_user.id, update.message, prompt, caption)
 
 async def handle_video_generation(update: Update, prompt: str):
     """Генерация видео (заглушка для будущей интеграции)"""
@@ -332,8 +348,10 @@ async def handle_video_generation(update: Update, prompt: str):
 async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /clear - очистка истории чата"""
     user_id = update.message.from_user.id
+    # Ответ, который сейчас генерируется, относится к очищенной истории
+    lanes.cancel(user_id)
     if user_id in user_contexts and 'history' in user_contexts[user_id]:
-        user_contexts[user_id]['history'] = []
+        reset_history(user_contexts[user_id])
         await update.message.reply_text("✅ История чата очищена")
     else:
         await update.message.reply_text("История уже пуста")
@@ -346,16 +364,32 @@ async def handle_translate(update: Update, user_id: int, message: str):
         )
         return
     
-    await update.message.reply_text("🌍 Перевожу...")
-    prompt = f"Переведи текст: {message}"
-    
-    response = client.chat.completions.create(
-        model=AI_MODEL,
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=500
-    )
-    
-    await update.message.reply_text(f"✅ {response.choices[0].message.content}")
+    # Языки разбираются локально: "английский, немецкий: текст"; язык текста
+    # определяется на месте - перевод на тот же язык и текст без слов не идут к AI
+    targets, text, source, translations = plan_translation(message)
+    
+    status = None
+    if targets:
+        prompt = build_prompt(targets, text, source)
+        tier = translate_tier(targets, text)
+        model = engine.model_for(tier.fast)
+        answer = await response_cache.get('translate', prompt, model, tier.max_tokens)
+        if answer is None:
+            status = await update.message.reply_text("🌍 Перевожу...")
+            # Одинаковые запросы, пришедшие одновременно, выполняются один раз
+            answer = await response_cache.compute(
+                'translate', prompt, model, tier.max_tokens,
+                counted('translate', tier, lambda: engine.chat(
+                    [{"role": "user", "content": prompt}], max_tokens=tier.max_tokens, fast=tier.fast
+                ))
+            )
+        translations += split_translations(targets, answer)
+    
+    # Все языки переведены одним запросом, каждый перевод - отдельным сообщением
+    for language, translation in translations:
+        title = f"✅ {language.capitalize()}:\n\n" if language else "✅ "
+        await send_answer(update.message, f"{title}{translation}", status)
+        status = None
 
 async def handle_summary(update: Update, user_id: int, message: str):
     """Резюме текста"""
@@ -365,16 +399,26 @@ async def handle_summary(update: Update, user_id: int, message: str):
         )
         return
     
-    await update.message.reply_text("📝 Создаю резюме...")
     prompt = f"Создай краткое резюме текста:\n\n{message}"
     
-    response = client.chat.completions.create(
-        model=AI_MODEL,
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=500
-    )
-    
-    await update.message.reply_text(f"📝 Резюме:\n\n{response.choices[0].message.content}")
+    status = None
+    tier = summary_tier(message)
+    model = engine.model_for(tier.fast)
+    answer = await response_cache.get('summary', prompt, model, tier.max_tokens, source=message)
+    if answer is None:
+        if is_long_text(message):
+            # Длинный текст: фрагменты резюмируются параллельно, затем объединяются
+            status = await update.message.reply_text("📝 Текст длинный, обрабатываю по частям...")
+            factory = lambda: summarize_long(message, engine.chat, slot=lambda: scheduler.subtask(user_id))
+        else:
+            status = await update.message.reply_text("📝 Создаю резюме...")
+            factory = counted('summary', tier, lambda: engine.chat(
+                [{"role": "user", "content": prompt}], max_tokens=tier.max_tokens, fast=tier.fast
+            ))
+        # Одинаковые запросы, пришедшие одновременно, выполняются один раз
+        answer = await response_cache.compute('summary', prompt, model, tier.max_tokens, factory, source=message)
+    
+    await send_answer(update.message, f"📝 Резюме:\n\n{answer}", status)
 
 async def handle_ideas(update: Update, user_id: int, message: str):
     """Генерация идей"""
@@ -384,16 +428,85 @@ async def handle_ideas(update: Update, user_id: int, message: str):
         )
         return
     
-    await update.message.reply_text("💡 Генерирую идеи...")
     prompt = f"Предложи 5 креативных идей на тему: {message}"
     
-    response = client.chat.completions.create(
-        model=AI_MODEL,
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=800
+    status = None
+    tier = ideas_tier(message)
+    model = engine.model_for(tier.fast)
+    answer = await response_cache.get('ideas', prompt, model, tier.max_tokens, source=message)
+    if answer is None:
+        status = await update.message.reply_text("💡 Генерирую идеи...")
+        # Одинаковые запросы, пришедшие одновременно, выполняются один раз
+        answer = await response_cache.compute(
+            'ideas', prompt, model, tier.max_tokens,
+            counted('ideas', tier, lambda: engine.chat(
+                [{"role": "user", "content": prompt}], max_tokens=tier.max_tokens, fast=tier.fast
+            )),
+            source=message
+        )
+    
+    await send_answer(update.message, f"💡 Идеи:\n\n{answer}", status)
+
+async def startup(application: Application):
+    """Запуск фоновых задач"""
+    global metrics_server
+    startup_timer.mark("подключение к Telegram")
+    await user_contexts.start()
+    image_jobs.start()
+    metrics_server = await start_metrics_server()
+    startup_timer.mark("фоновые задачи")
+    
+    # Соединения с AI и Telegram открываются заранее и параллельно - до приема сообщений
+    await warm_up(engine, application.bot)
+    startup_timer.mark("прогрев соединений")
+    logger.info(startup_timer.summary())
+
+async def shutdown(application: Application):
+    """Закрытие соединений с AI провайдером и сохранение сессий"""
+    await image_jobs.close()
+    await engine.aclose()
+    if metrics_server is not None:
+        metrics_server.close()
+    await user_contexts.close()
+    logger.info("Кэш ответов: %s", response_cache.stats())
+    logger.info("Изображения: %s", image_jobs.stats())
+    logger.info("Очереди пользователей: %s", lanes.stats())
+    response_cache.close()
+
+async def preload_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выгруженная сессия загружается в фоновом потоке до обработчиков"""
+    if update.effective_user:
+        await user_contexts.preload(update.effective_user.id)
+
+def build_application(token: str, request=None) -> Application:
+    """Создание приложения с обработчиками (request - свой HTTP клиент для Bot API)"""
+    startup_timer.mark("загрузка модулей")
+    # Создание приложения
+    application = (
+        Application.builder()
+        .token(token)
+        .request(request or telegram_request(proxy_url))
+        .rate_limiter(OutboxRateLimiter())
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(startup)
+        .post_shutdown(shutdown)
+        .build()
     )
     
-    await update.message.reply_text(f"💡 Идеи:\n\n{response.choices[0].message.content}")
+    # Регистрация обработчиков
+    application.add_handler(TypeHandler(Update, preload_session), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("menu", menu))
+    application.add_handler(CommandHandler("clear", clear_history))
+    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension("txt") | filters.Document.FileExtension("md")
+        | filters.Document.FileExtension("html") | filters.Document.FileExtension("htm"),
+        handle_document
+    ))
+    
+    return application
 
 def main():
     """Запуск бота"""
@@ -406,16 +519,6 @@ def main():
         logger.error("TELEGRAM_BOT_TOKEN не найден в переменных окружения!")
         return
     
-    # Создание приложения
-    application = Application.builder().token(token).build()
-    
-    # Регистрация обработчиков
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("menu", menu))
-    application.add_handler(CommandHandler("clear", clear_history))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    
     # Запуск бота
     logger.info("Бот запущен!")
     
@@ -426,7 +529,15 @@ def main():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if SHARD_WORKERS > 1:
+        # Процесс приема обновлений + SHARD_WORKERS процессов-обработчиков
+        sharding.run(build_application, token)
+        return
+    
+    application = build_application(token)
+    
+    # polling или webhook (BOT_MODE), только нужные типы обновлений
+    launcher.run(application)
 
 if __name__ == '__main__':
-    main()
+    main()
\ No newline at end of file
@@ -0,0 +1,116 @@
+import os
+
+# Бюджет токенов на историю чата (вместе с кратким содержанием)
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '3000'))
+
+# Сколько токенов свежих сообщений оставлять дословно после сжатия
+HISTORY_KEEP_TOKENS = int(os.getenv('HISTORY_KEEP_TOKENS', str(HISTORY_TOKEN_BUDGET // 2)))
+
+# Размер краткого содержания старой части диалога
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '300'))
+
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD = 4
+
+# Сколько символов одного сообщения попадает в запрос на сжатие
+SUMMARY_INPUT_CHARS = 2000
+
+ROLE_NAMES = {"user": "Пользователь", "assistant": "Ассистент", "system": "Система"}
+
+
+def estimate_tokens(text: str) -> int:
+    """Быстрая локальная оценка числа токенов (~4 байта UTF-8 на токен)"""
+    return len(text.encode('utf-8')) // 4 + 1
+
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(message['content']) + MESSAGE_OVERHEAD
+
+
+def _history_tokens(session: dict) -> int:
+    """Текущий счетчик токенов истории (пересчитывается, если его нет)"""
+    if 'history_tokens' not in session:
+        session['history_tokens'] = sum(message_tokens(m) for m in session.get('history', []))
+    return session['history_tokens']
+
+
+def total_tokens(session: dict) -> int:
+    summary = session.get('summary')
+    return _history_tokens(session) + (estimate_tokens(summary) if summary else 0)
+
+
+def reset_history(session: dict):
+    """Очистка истории вместе с кратким содержанием и счетчиком токенов"""
+    session['history'] = []
+    session['history_tokens'] = 0
+    session.pop('summary', None)
+
+
+def append_message(session: dict, role: str, content: str):
+    """Добавление сообщения в историю с обновлением счетчика токенов"""
+    tokens = _history_tokens(session)
+    message = {"role": role, "content": content}
+    session.setdefault('history', []).append(message)
+    session['history_tokens'] = tokens + message_tokens(message)
+
+
+def build_messages(session: dict) -> list:
+    """Сообщения для запроса к AI: краткое содержание + свежая история"""
+    messages = list(session.get('history', []))
+    if session.get('summary'):
+        messages.insert(0, {
+            "role": "system",
+            "content": f"Краткое содержание предыдущей части диалога: {session['summary']}"
+        })
+    return messages
+
+
+def _summary_prompt(previous: str, messages: list) -> list:
+    lines = []
+    for m in messages:
+        content = m['content']
+        if len(content) > SUMMARY_INPUT_CHARS:
+            content = content[:SUMMARY_INPUT_CHARS] + "…"
+        lines.append(f"{ROLE_NAMES.get(m['role'], m['role'])}: {content}")
+
+    text = "Сожми диалог в краткое содержание (не больше 5 предложений). "
+    text += "Сохрани факты, имена, цифры и договоренности, без вступлений.\n\n"
+    if previous:
+        text += f"Ранее: {previous}\n\n"
+    text += "\n".join(lines)
+    return [{"role": "user", "content": text}]
+
+
+async def compact_history(session: dict, chat) -> bool:
+    """Сжатие старых сообщений в краткое содержание при превышении бюджета
+
+    chat - корутина chat(messages, max_tokens) -> str (например, engine.chat).
+    Последнее сообщение всегда остается дословно.
+    """
+    if total_tokens(session) <= HISTORY_TOKEN_BUDGET:
+        return False
+
+    history = session['history']
+    keep = 0
+    kept_tokens = 0
+    for message in reversed(history):
+        tokens = message_tokens(message)
+        if keep and kept_tokens + tokens > HISTORY_KEEP_TOKENS:
+            break
+        keep += 1
+        kept_tokens += tokens
+
+    old = history[:len(history) - keep]
+    if not old:
+        return False
+
+    summary = await chat(_summary_prompt(session.get('summary'), old), max_tokens=SUMMARY_MAX_TOKENS)
+
+    # История могла измениться за время запроса (/clear, смена режима)
+    if session.get('history') is not history or history[:len(old)] != old:
+        return False
+
+    del history[:len(old)]
+    session['summary'] = summary
+    session['history_tokens'] = sum(message_tokens(m) for m in history)
+    return True
@@ -0,0 +1,200 @@
+import os
+import re
+import math
+import asyncio
+import logging
+from html.parser import HTMLParser
+from chat_history import estimate_tokens
+from resilience import extend_deadline
+
+logger = logging.getLogger(__name__)
+
+# Поддерживаемые форматы документов для резюме
+DOCUMENT_EXTENSIONS = ('txt', 'md', 'html', 'htm')
+
+# Максимальный размер документа (байты): 512 КБ - около 64 фрагментов, 8 кругов
+# запросов при SUMMARY_CONCURRENCY=8
+MAX_DOCUMENT_BYTES = int(os.getenv('MAX_DOCUMENT_BYTES', str(512 * 1024)))
+
+# Размер фрагмента длинного текста (токены) и сколько фрагментов обрабатывать одновременно
+SUMMARY_CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', '2000'))
+SUMMARY_CONCURRENCY = int(os.getenv('SUMMARY_CONCURRENCY', '8'))
+
+# Время на один круг параллельных запросов (секунды): дедлайн резюме длинного
+# текста продлевается на число кругов
+SUMMARY_ROUND_SECONDS = float(os.getenv('SUMMARY_ROUND_SECONDS', '30'))
+
+# Размер резюме фрагмента и итогового резюме
+PART_SUMMARY_TOKENS = 300
+FINAL_SUMMARY_TOKENS = 500
+
+SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+
+
+class DocumentError(Exception):
+    """Документ нельзя обработать (размер, формат)"""
+
+
+class _TextExtractor(HTMLParser):
+    """Текст из HTML без тегов, скриптов и стилей"""
+
+    SKIP = {'script', 'style', 'head', 'noscript'}
+    BLOCKS = {'p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article'}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skipping += 1
+        elif tag in self.BLOCKS:
+            self.parts.append('\n\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+
+def extract_text(data: bytes, file_name: str) -> str:
+    """Текст документа (UTF-8 или Windows-1251, HTML без разметки)"""
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('cp1251', errors='replace')
+
+    if file_name.lower().endswith(('.html', '.htm')):
+        parser = _TextExtractor()
+        parser.feed(text)
+        text = ''.join(parser.parts)
+        text = re.sub(r'[ \t]+', ' ', text)
+        text = re.sub(r'\n\s*\n\s*', '\n\n', text)
+    return text.strip()
+
+
+async def read_document(document, http_client=None, limit: int = MAX_DOCUMENT_BYTES) -> str:
+    """Загрузка документа Telegram потоком в ограниченный буфер и извлечение текста"""
+    file_name = document.file_name or ''
+    if not file_name.lower().endswith(tuple('.' + ext for ext in DOCUMENT_EXTENSIONS)):
+        raise DocumentError("Поддерживаются только файлы .txt, .md и .html")
+    if document.file_size and document.file_size > limit:
+        raise DocumentError(f"Файл слишком большой (максимум {limit // 1024} КБ)")
+
+    file = await document.get_file()
+    if http_client is None:
+        data = bytes(await file.download_as_bytearray())
+    else:
+        buffer = bytearray()
+        async with http_client.stream('GET', file.file_path) as response:
+            response.raise_for_status()
+            async for part in response.aiter_bytes():
+                buffer.extend(part)
+                if len(buffer) > limit:
+                    raise DocumentError(f"Файл слишком большой (максимум {limit // 1024} КБ)")
+        data = bytes(buffer)
+
+    text = extract_text(data, file_name)
+    if not text:
+        raise DocumentError("В документе нет текста")
+    return text
+
+
+def is_long_text(text: str) -> bool:
+    return estimate_tokens(text) > SUMMARY_CHUNK_TOKENS
+
+
+def _split_long(paragraph: str, chunk_tokens: int) -> list:
+    """Разбиение абзаца больше фрагмента по предложениям (или жестко по длине)"""
+    pieces = []
+    for sentence in SENTENCE_END.split(paragraph):
+        while estimate_tokens(sentence) > chunk_tokens:
+            # ~4 байта на токен, для кириллицы 2 байта на символ - берем с запасом
+            cut = chunk_tokens * 2
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:]
+        pieces.append(sentence)
+    return pieces
+
+
+def split_chunks(text: str, chunk_tokens: int = SUMMARY_CHUNK_TOKENS) -> list:
+    """Разбиение текста на фрагменты по границам абзацев в пределах бюджета токенов"""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in re.split(r'\n\s*\n', text):
+        for piece in _split_long(paragraph, chunk_tokens):
+            tokens = estimate_tokens(piece)
+            if current and current_tokens + tokens > chunk_tokens:
+                chunks.append('\n\n'.join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        chunks.append('\n\n'.join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def summary_rounds(chunks: int, concurrency: int = SUMMARY_CONCURRENCY) -> int:
+    """Сколько кругов запросов займет резюме: фрагменты, объединение, итог"""
+    return math.ceil(chunks / concurrency) + math.ceil(math.log2(max(chunks, 2))) + 1
+
+
+async def summarize_long(text: str, chat, chunk_tokens: int = SUMMARY_CHUNK_TOKENS,
+                         concurrency: int = SUMMARY_CONCURRENCY, slot=None) -> str:
+    """Резюме длинного текста: фрагменты параллельно, затем иерархическое объединение
+
+    chat - корутина chat(messages, max_tokens) -> str (например, engine.chat).
+    slot - фабрика места в очереди к AI (scheduler.subtask) для каждого запроса,
+    кроме одного, который идет на месте самого сообщения.
+    """
+    chunks = split_chunks(text, chunk_tokens)
+    logger.info("Резюме длинного текста: %d фрагментов", len(chunks))
+    with extend_deadline(summary_rounds(len(chunks), concurrency) * SUMMARY_ROUND_SECONDS):
+        return await _summarize_chunks(chunks, chat, chunk_tokens, concurrency, slot)
+
+
+async def _summarize_chunks(chunks: list, chat, chunk_tokens: int, concurrency: int, slot) -> str:
+    semaphore = asyncio.Semaphore(concurrency)
+    # Место сообщения уже занято: один запрос идет на нем, поэтому резюме
+    # продвигается, даже когда все остальные места заняты
+    own = asyncio.Lock()
+
+    async def ask(prompt: str, max_tokens: int) -> str:
+        messages = [{"role": "user", "content": prompt}]
+        async with semaphore:
+            if slot is None:
+                return await chat(messages, max_tokens=max_tokens)
+            if not own.locked():
+                async with own:
+                    return await chat(messages, max_tokens=max_tokens)
+            async with slot():
+                return await chat(messages, max_tokens=max_tokens)
+
+    parts = await asyncio.gather(*[
+        ask(f"Кратко перескажи фрагмент {i + 1} из {len(chunks)} текста, сохрани ключевые факты:\n\n{chunk}",
+            PART_SUMMARY_TOKENS)
+        for i, chunk in enumerate(chunks)
+    ])
+
+    # Пока резюме частей не помещаются в один запрос - объединяем их группами
+    while len(parts) > 1 and sum(estimate_tokens(p) for p in parts) > chunk_tokens:
+        groups = split_chunks('\n\n'.join(parts), chunk_tokens)
+        if len(groups) >= len(parts):
+            groups = ['\n\n'.join(parts[i:i + 2]) for i in range(0, len(parts), 2)]
+        parts = await asyncio.gather(*[
+            ask(f"Объедини краткие изложения частей текста в одно, сохрани ключевые факты:\n\n{group}",
+                PART_SUMMARY_TOKENS)
+            for group in groups
+        ])
+
+    joined = '\n\n'.join(parts)
+    return await ask(
+        f"Ниже краткие изложения частей одного текста. Составь из них краткое и понятное резюме всего текста:\n\n{joined}",
+        FINAL_SUMMARY_TOKENS
+    )
@@ -0,0 +1,89 @@
+import os
+import logging
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Таймаут запроса к провайдеру (секунды)
+REQUEST_TIMEOUT = float(os.getenv('AI_REQUEST_TIMEOUT', '60'))
+
+# Пул соединений: всего соединений, из них держать открытыми, время жизни простаивающих
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '100'))
+HTTP_KEEPALIVE = int(os.getenv('HTTP_KEEPALIVE', '20'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '60'))
+
+# HTTP/2 (нужен пакет h2: pip install httpx[http2])
+HTTP2 = os.getenv('HTTP2', '1') == '1'
+
+# Хосты, которые ходят через PROXY_URL (через запятую).
+# Пусто - через прокси идут все запросы к AI, Telegram (Bot API и загрузка файлов) - напрямую
+PROXY_HOSTS = [host.strip() for host in os.getenv('PROXY_HOSTS', '').split(',') if host.strip()]
+
+TELEGRAM_HOST = 'api.telegram.org'
+
+
+def http2_available() -> bool:
+    if not HTTP2:
+        return False
+    try:
+        import h2
+    except ImportError:
+        logger.warning("HTTP/2 недоступен (нет пакета h2), используется HTTP/1.1")
+        return False
+    return True
+
+
+def proxy_for(host: str, proxy_url: str = None):
+    """Прокси для хоста с учетом PROXY_HOSTS"""
+    if not proxy_url:
+        return None
+    if not PROXY_HOSTS:
+        return None if host == TELEGRAM_HOST else proxy_url
+    if any(host == h or host.endswith('.' + h) for h in PROXY_HOSTS):
+        return proxy_url
+    return None
+
+
+def create_http_client(proxy_url: str = None) -> httpx.AsyncClient:
+    """Общий пул соединений для всех провайдеров и загрузки изображений"""
+    http2 = http2_available()
+    limits = httpx.Limits(
+        max_connections=HTTP_POOL_SIZE,
+        max_keepalive_connections=HTTP_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+
+    def transport(proxy: str = None):
+        return httpx.AsyncHTTPTransport(http2=http2, limits=limits, proxy=proxy)
+
+    mounts = {}
+    if proxy_url and PROXY_HOSTS:
+        # Через прокси только перечисленные хосты, остальное напрямую
+        proxied = transport(proxy_url)
+        for host in PROXY_HOSTS:
+            mounts[f"all://{host}"] = proxied
+            mounts[f"all://*.{host}"] = proxied
+        default = transport()
+    else:
+        default = transport(proxy_url or None)
+        if proxy_url:
+            # Файлы из Telegram (документы для резюме) - напрямую, как и Bot API
+            mounts[f"all://{TELEGRAM_HOST}"] = transport()
+
+    return httpx.AsyncClient(
+        transport=default,
+        mounts=mounts,
+        timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=10.0)
+    )
+
+
+def telegram_request(proxy_url: str = None):
+    """HTTP клиент для Bot API с теми же настройками пула и прокси"""
+    from telegram.request import HTTPXRequest
+
+    return HTTPXRequest(
+        connection_pool_size=HTTP_KEEPALIVE,
+        http_version="2" if http2_available() else "1.1",
+        write_timeout=30.0,
+        proxy=proxy_for(TELEGRAM_HOST, proxy_url)
+    )
@@ -0,0 +1,217 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from telegram.error import BadRequest
+from response_cache import CACHE_DB_PATH, ResponseCache
+from scheduler import RateLimited
+from resilience import deadline
+from log_pipeline import log_context
+from metrics import IMAGE_JOBS
+
+logger = logging.getLogger(__name__)
+
+# Сколько изображений генерируется одновременно
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+
+# Сколько заданий может ждать в очереди (всего и от одного пользователя)
+IMAGE_MAX_QUEUE = int(os.getenv('IMAGE_MAX_QUEUE', '50'))
+IMAGE_MAX_PER_USER = int(os.getenv('IMAGE_MAX_PER_USER', '2'))
+
+# Как часто обновлять сообщение с позицией в очереди и ходом генерации (секунды)
+IMAGE_PROGRESS_INTERVAL = float(os.getenv('IMAGE_PROGRESS_INTERVAL', '5'))
+
+# Сколько хранить file_id готовых изображений (секунды) и сколько записей в памяти
+IMAGE_CACHE_TTL = float(os.getenv('IMAGE_CACHE_TTL', str(30 * 86400)))
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv('IMAGE_CACHE_MAX_ENTRIES', '1000'))
+
+IMAGE_MODEL = "dall-e-3"
+
+
+class ImageJob:
+    """Задание на генерацию: запрос, сообщение пользователя и сообщение-статус"""
+
+    __slots__ = ('user_id', 'prompt', 'size', 'quality', 'caption', 'message', 'status', 'started', 'progress_task')
+
+    def __init__(self, user_id: int, prompt: str, size: str, quality: str, caption: str, message):
+        self.user_id = user_id
+        self.prompt = prompt
+        self.size = size
+        self.quality = quality
+        self.caption = caption
+        self.message = message
+        self.status = None
+        self.started = None
+        self.progress_task = None
+
+    @property
+    def variant(self) -> str:
+        """Модель и параметры - часть ключа кэша"""
+        return f"{IMAGE_MODEL}/{self.size}/{self.quality}"
+
+
+class ImageJobs:
+    """Генерация изображений в фоне на ограниченном пуле обработчиков
+
+    Пользователь сразу получает сообщение с местом в очереди, которое
+    обновляется по ходу работы. Готовое изображение запоминается по
+    file_id Telegram: повторный запрос отправляется без генерации и загрузки.
+    """
+
+    def __init__(self, engine, workers: int = IMAGE_WORKERS, max_queue: int = IMAGE_MAX_QUEUE,
+                 max_per_user: int = IMAGE_MAX_PER_USER, cache: ResponseCache = None):
+        self.engine = engine
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.cache = cache or ResponseCache(
+            modes={'image'}, max_entries=IMAGE_CACHE_MAX_ENTRIES, ttl=IMAGE_CACHE_TTL, db_path=CACHE_DB_PATH,
+            db_table='images'
+        )
+        self.pending = deque()
+        self.running = []
+        self.per_user = {}
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+        self.reused = 0
+        self.generated = 0
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for job in list(self.pending) + self.running:
+            if job.progress_task is not None:
+                job.progress_task.cancel()
+        self.cache.close()
+
+    async def send_cached(self, message, prompt: str, caption: str,
+                          size: str = "1024x1024", quality: str = "standard") -> bool:
+        """Отправка уже готового изображения по file_id (False - в кэше нет)"""
+        variant = f"{IMAGE_MODEL}/{size}/{quality}"
+        file_id = await self.cache.get('image', prompt, variant, 0)
+        if file_id is None:
+            return False
+        try:
+            await message.reply_photo(photo=file_id, caption=caption)
+        except BadRequest as e:
+            # file_id другого бота или удаленного файла - генерируем заново
+            logger.info("file_id из кэша не подошел: %s", e)
+            await self.cache.forget('image', prompt, variant, 0)
+            return False
+        self.reused += 1
+        return True
+
+    async def submit(self, user_id: int, message, prompt: str, caption: str,
+                     size: str = "1024x1024", quality: str = "standard") -> ImageJob:
+        """Постановка задания в очередь; результат придет отдельным сообщением"""
+        if self.per_user.get(user_id, 0) >= self.max_per_user:
+            raise RateLimited("Дождитесь готовности предыдущих изображений")
+        if len(self.pending) >= self.max_queue:
+            raise RateLimited("Очередь генерации изображений заполнена", retry_after=30.0)
+
+        job = ImageJob(user_id, prompt, size, quality, caption, message)
+        self.per_user[user_id] = self.per_user.get(user_id, 0) + 1
+        try:
+            # Статус отправляется до постановки в очередь - обработчик может взять задание сразу
+            job.status = await message.reply_text(self._queued_text(len(self.pending)))
+        except BaseException:
+            self._release_user(user_id)
+            raise
+        self.pending.append(job)
+        IMAGE_JOBS.inc(state='queued')
+        job.progress_task = asyncio.create_task(self._progress(job))
+        self.wakeup.set()
+        return job
+
+    def _release_user(self, user_id: int):
+        self.per_user[user_id] -= 1
+        if not self.per_user[user_id]:
+            del self.per_user[user_id]
+
+    def _queued_text(self, index: int) -> str:
+        # Первые задания очереди сразу заберут свободные обработчики
+        place = index - (self.workers - len(self.running)) + 1
+        if place <= 0:
+            return "🎨 Генерирую изображение..."
+        return f"🎨 Запрос в очереди, место: {place}"
+
+    def _status_text(self, job: ImageJob) -> str:
+        if job.started is not None:
+            return f"🎨 Генерирую изображение... {int(time.monotonic() - job.started)} с"
+        return self._queued_text(self.pending.index(job))
+
+    async def _progress(self, job: ImageJob):
+        """Периодическое обновление сообщения-статуса"""
+        text = job.status.text
+        while True:
+            await asyncio.sleep(IMAGE_PROGRESS_INTERVAL)
+            new_text = self._status_text(job)
+            if new_text == text:
+                continue
+            try:
+                await job.status.edit_text(new_text)
+                text = new_text
+            except BadRequest:
+                pass
+
+    async def _worker(self):
+        while True:
+            while not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            job = self.pending.popleft()
+            IMAGE_JOBS.dec(state='queued')
+            IMAGE_JOBS.inc(state='running')
+            job.started = time.monotonic()
+            self.running.append(job)
+            try:
+                with deadline('image'), log_context(user_id=job.user_id, mode='image'):
+                    await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка генерации изображения: %s", e)
+                try:
+                    await job.status.edit_text(f"❌ Ошибка генерации изображения: {e}")
+                except BadRequest:
+                    pass
+            finally:
+                self.running.remove(job)
+                IMAGE_JOBS.dec(state='running')
+                job.progress_task.cancel()
+                self._release_user(job.user_id)
+
+    async def _run(self, job: ImageJob):
+        uploaded = False
+
+        async def generate() -> str:
+            nonlocal uploaded
+            image_url = await self.engine.generate_image(job.prompt, job.size, job.quality)
+            image = await self.engine.fetch(image_url)
+            sent = await job.message.reply_photo(photo=image, caption=job.caption)
+            uploaded = True
+            self.generated += 1
+            return sent.photo[-1].file_id
+
+        # Одинаковые запросы в работе генерируются один раз, остальным уходит file_id
+        file_id = await self.cache.compute('image', job.prompt, job.variant, 0, generate)
+        if not uploaded:
+            await job.message.reply_photo(photo=file_id, caption=job.caption)
+            self.reused += 1
+        try:
+            await job.status.delete()
+        except BadRequest:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            'queued': len(self.pending),
+            'running': len(self.running),
+            'generated': self.generated,
+            'reused': self.reused,
+        }
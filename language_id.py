@@ -0,0 +1,222 @@
+import re
+from collections import Counter
+
+# Сколько символов текста смотреть при определении языка
+SAMPLE_CHARS = 160
+
+# Минимум букв для уверенного определения по n-граммам
+MIN_LETTERS = 10
+
+# Во сколько раз лучший язык должен опережать второй
+MIN_MARGIN = 1.3
+
+# Перевес, при котором языку текста можно верить без AI: текст уже на нужном
+# языке отдается как есть, язык подсказывается в запросе на перевод
+SURE_MARGIN = 2.0
+
+# Частые триграммы языков (пробел - граница слова), по убыванию частоты
+PROFILES = {
+    'английский': (
+        ' th', 'the', 'he ', 'and', ' an', 'nd ', 'ing', ' to', 'to ', 'ng ', 'er ', ' of', 'of ', 'in ',
+        'is ', ' is', 'ion', ' in', 'ed ', 'tio', 'at ', 'on ', 're ', 'it ', ' it', 'you', ' yo', 'ou ',
+        ' wh', 'hat', ' ha', 'for', ' fo', 'or ', 'es ', ' be', 'ent', 'her', 'ter', 'was', 'are', ' we',
+        ' co', 'ly ', 'll ', 'ow ', 'ay ', 'thi', 'ank', 'hel',
+    ),
+    'немецкий': (
+        'en ', 'er ', 'ch ', 'der', 'ie ', 'ein', 'sch', 'ich', 'nde', 'die', ' di', ' de', 'den', 'cht',
+        ' ei', 'und', ' un', 'nd ', 'che', 'ung', 'ine', ' ge', 'gen', 'te ', 'ist', ' is', 'ge ', ' ic',
+        'nic', 'ht ', 'auf', 'das', ' da', ' zu', 'zu ', 'mit', ' mi', 'sie', ' si', 'eit', 'hen', 'ier',
+        'nen', 'wir', ' wi', 'ber', 'ute', 'gut', 'ank', 'ied', 'ehr', 'nke', 'uch', 'ach',
+    ),
+    'французский': (
+        'es ', ' de', 'de ', 'le ', ' le', 'ent', 'nt ', 'la ', ' la', 'les', ' co', 're ', 'on ', ' pa',
+        'ion', ' et', 'et ', 'que', ' qu', 'ue ', 'ous', 'our', ' po', 'des', ' un', 'une', 'ne ', 'ais',
+        'est', ' es', 'ait', ' ce', 'ce ', ' ne', 'pas', 'ans', 'dan', ' da', 'ez ', 'vou', ' vo', 'eur',
+        'tre', 'oui', ' je', 'je ', 'bon', 'jou', 'ci ', 'erc',
+    ),
+    'испанский': (
+        'de ', ' de', 'os ', 'la ', ' la', 'el ', ' el', 'es ', 'en ', ' en', 'que', ' qu', 'ue ', 'as ',
+        'ado', ' co', 'con', 'er ', 'ent', 'ar ', ' lo', 'los', ' se', ' es', 'est', 'nte', 'ara', ' pa',
+        'par', 'por', ' po', 'una', ' un', 'mos', 'dos', 'no ', ' no', 'sta', 'hol', 'ola', 'gra', 'cia',
+        'ias', 'ien', 'ero', 'ues', 'bue', 'uen', 'ás ',
+    ),
+    'итальянский': (
+        'di ', ' di', 'la ', 'che', ' ch', 'he ', 're ', 'to ', 'ne ', 'el ', 'del', ' de', 'le ', 'zio',
+        'ion', 'one', ' co', 'no ', 'ent', 'ell', 'lla', 'per', ' pe', ' il', 'il ', 'non', ' no', 'ato',
+        'sso', 'gli', 'sta', 'ere', 'are', 'tto', 'ono', 'cia', 'iao', 'gra', 'azi', 'zie', 'ie ', 'sei',
+        'com', 'ome', 'ual', 'uon', 'buo', 'ett', 'ggi', 'olt', 'lto', 'zza',
+    ),
+    'португальский': (
+        'de ', ' de', 'os ', 'que', ' qu', 'ue ', ' co', 'do ', 'da ', 'ão ', 'ção', ' a ', 'ent', 'em ',
+        'es ', 'to ', 'as ', 'nte', ' se', ' pa', 'par', 'com', 'uma', ' um', 'não', 'ões', 'ado', 'dos',
+        'ara', 'mos', 'est', 'obr', 'rig', 'iga', 'olá', 'voc', 'ocê', 'cê ', 'ou ', 'tá ', 'ito', 'uit',
+    ),
+    'польский': (
+        'nie', ' ni', 'ie ', 'ch ', 'dzi', 'ego', ' pr', 'prz', 'rze', 'ze ', 'wie', 'się', 'ię ', 'ść ',
+        'cze', 'owa', 'ani', ' na', 'na ', ' po', 'est', 'jak', ' ja', 'ak ', 'to ', 'nia', 'ał ', 'ym ',
+        'zię', 'ięk', 'kuj', 'uję', 'eś ', 'jes', 'wsz',
+    ),
+    'турецкий': (
+        'lar', 'ler', 'bir', ' bi', 'ir ', 'in ', 'ın ', 'an ', 'en ', 'da ', 'de ', 'eri', 'ara', 'ini',
+        'yor', 'ıyo', 'iyo', ' ve', 've ', 'ası', 'esi', 'nda', 'nde', 'içi', 'çin', 'ık ', 'ük ', 'teş',
+        'şek', 'kür', 'rha', 'mer', 'hab', 'ba ', 'nas', 'sın', 'ıl ', 'um ', 'ede', 'ere', 'ne ',
+    ),
+    'русский': (
+        ' пр', 'ть ', 'то ', 'ого', 'ени', ' по', 'ет ', 'ом ', ' на', 'на ', 'ния', ' не', 'не ', 'ост',
+        'ает', 'ать', ' в ', 'ов ', 'ся ', 'что', ' чт', 'как', ' ка', 'это', ' эт', 'его', 'ые ', 'ый ',
+        'ий ', 'при', 'спа', 'аси', 'ибо', 'вет', 'рив', 'ела', 'дел', ' вы', 'ты ', 'ли ', 'тся', ' гд', 'где',
+        ' и ', ' с ', ' к ', ' за', ' от', ' до', ' со', 'ова', 'ств', 'про', ' ку', 'ить', 'ной', 'ных',
+        'ное', 'ная', 'сти', 'ние', 'ост', 'ово', 'оло', 'ько', 'ждо', ' вс', 'все', 'дня', ' дн', 'ень',
+        'ый ', 'ой ', 'ем ', 'ими', 'ами', 'ому', ' мо', 'ело', 'хор', 'оро', 'ошо',
+    ),
+    'украинский': (
+        'ння', 'ти ', ' пр', 'ий ', 'ні ', 'ого', ' на', 'на ', 'ть ', 'що ', ' що', ' і ', 'ся ', 'ві ',
+        'ав ', 'их ', 'не ', 'ють', 'цьо', 'дяк', 'яку', 'ую ', 'віт', 'як ', 'сть', 'ити', ' ві', 'тьс',
+        'ься', ' де', 'де ',
+    ),
+    'белорусский': (
+        'ная', 'ць ', 'аў ', 'ага', ' і ', 'ыя ', 'ння', 'дзя', 'дзе', ' дз', 'зяк', 'кую', 'ваш',
+    ),
+    # Южнославянские языки похожи на русский по буквам - без них их текст "определялся" как русский
+    'болгарский': (
+        ' на', 'на ', 'та ', ' се', 'се ', ' да', 'да ', 'ата', 'ите', ' е ', 'то ', 'ето', ' за', 'за ',
+        'ва ', 'ът ', ' съ', 'ния', 'ост', 'ни ', 'ото', 'щта', 'ощт', 'тоз', 'ози', 'каз', ' ще', 'ще ',
+        ' си', 'си ', ' ти', 'аря', 'ря ', 'дар', 'вей', 'ей ', 'мно', 'ого', ' аз', 'аз ', 'тез', 'ики',
+        'ям ', 'ме ', 'ват', 'ува',
+    ),
+    'сербский': (
+        ' је', 'је ', ' да', 'да ', ' се', 'се ', 'ије', ' на', 'на ', ' и ', 'ња ', 'ање', 'ти ', ' по',
+        'ко ', 'ако', 'као', 'ало', 'ла ', 'ом ', 'ово', 'што', ' шт', 'ају', 'мо ', 'хва', 'вал', 'пун',
+        'уно', 'ћи ', 'оћи', 'ред', 'ава', 'во ', 'ни ', 'или', 'ити', 'ега',
+    ),
+    'македонский': (
+        ' на', 'на ', 'та ', ' се', 'се ', ' да', 'да ', 'ата', 'ите', 'от ', ' од', 'од ', 'ски', 'ње ',
+        'ва ', ' ќе', 'ќе ', 'рам', 'ам ', 'мно', 'ног', 'огу', 'гу ', 'ошт', 'шта', ' ви', 'ви ', 'ако',
+        'ко ', 'ија', 'ја ', 'ови', 'вам', 'аво', 'во ', 'ме ',
+    ),
+}
+
+# Буквы, характерные для одного или нескольких языков
+MARKERS = {
+    'ß': ('немецкий',), 'ä': ('немецкий',), 'ö': ('немецкий', 'турецкий'), 'ü': ('немецкий', 'турецкий'),
+    'ñ': ('испанский',), '¿': ('испанский',), '¡': ('испанский',),
+    'á': ('испанский', 'португальский'), 'í': ('испанский', 'португальский'), 'ú': ('испанский', 'португальский'),
+    'ó': ('испанский', 'португальский', 'польский'),
+    'ã': ('португальский',), 'õ': ('португальский',),
+    'ê': ('португальский', 'французский'), 'â': ('португальский', 'французский', 'турецкий'),
+    'ô': ('португальский', 'французский'), 'ç': ('португальский', 'французский', 'турецкий'),
+    'à': ('французский', 'итальянский', 'португальский'), 'è': ('французский', 'итальянский'),
+    'é': ('французский', 'итальянский', 'испанский', 'португальский'),
+    'ù': ('французский', 'итальянский'), 'î': ('французский', 'турецкий'), 'û': ('французский', 'турецкий'),
+    'ë': ('французский',), 'ï': ('французский',), 'œ': ('французский',), 'ì': ('итальянский',),
+    'ò': ('итальянский',),
+    'ą': ('польский',), 'ę': ('польский',), 'ł': ('польский',), 'ś': ('польский',), 'ź': ('польский',),
+    'ż': ('польский',), 'ń': ('польский',), 'ć': ('польский',),
+    'ğ': ('турецкий',), 'ş': ('турецкий',), 'ı': ('турецкий',),
+    'ы': ('русский', 'белорусский'), 'э': ('русский', 'белорусский'),
+    'ё': ('русский', 'белорусский'),
+    'і': ('украинский', 'белорусский', 'казахский'), 'є': ('украинский',), 'ї': ('украинский',),
+    'ґ': ('украинский',), 'ў': ('белорусский',),
+    'ә': ('казахский',), 'ғ': ('казахский',), 'қ': ('казахский',), 'ң': ('казахский',), 'ө': ('казахский',),
+    'ұ': ('казахский',), 'ү': ('казахский',), 'һ': ('казахский',),
+    'ђ': ('сербский',), 'ћ': ('сербский',), 'ј': ('сербский', 'македонский'), 'љ': ('сербский', 'македонский'),
+    'њ': ('сербский', 'македонский'), 'џ': ('сербский', 'македонский'), 'ѓ': ('македонский',),
+    'ќ': ('македонский',), 'ѕ': ('македонский',),
+}
+MARKER_WEIGHT = 5
+
+# Ъ есть и в русском, но только перед е, ё, ю, я ("подъезд"); иначе - болгарский ("България")
+BULGARIAN_HARD_SIGN = re.compile(r'ъ(?![еёюя])')
+
+# Языки, похожие на русский: без своих букв (или ъ у болгарского) не определяются
+NEEDS_MARKERS = {'болгарский', 'сербский', 'македонский'}
+
+# Письменности: диапазон кодов символов и язык, если он один
+SCRIPTS = (
+    ('LATIN', 0x61, 0x24f, None),
+    ('CYRILLIC', 0x430, 0x4ff, None),
+    ('ARABIC', 0x600, 0x6ff, 'арабский'),
+    ('DEVANAGARI', 0x900, 0x97f, 'хинди'),
+    ('KANA', 0x3040, 0x30ff, 'японский'),
+    ('CJK', 0x4e00, 0x9fff, 'китайский'),
+    ('HANGUL', 0xac00, 0xd7af, 'корейский'),
+)
+
+CYRILLIC = {'русский', 'украинский', 'белорусский', 'казахский', 'болгарский', 'сербский', 'македонский'}
+LATIN = set(PROFILES) - CYRILLIC
+
+
+def _gram_table(languages: set) -> dict:
+    """Триграмма -> [(язык, вес)]: один поиск в словаре на триграмму текста"""
+    table = {}
+    for language in languages & set(PROFILES):
+        grams = PROFILES[language]
+        for rank, gram in enumerate(grams):
+            # Вес от 3 (самая частая) до 1 (последняя в списке)
+            table.setdefault(gram, []).append((language, 1 + 2 * (len(grams) - rank) / len(grams)))
+    return table
+
+
+GRAMS = {'LATIN': _gram_table(LATIN), 'CYRILLIC': _gram_table(CYRILLIC)}
+
+# Ссылки, почта, упоминания, числа - не переводятся
+NON_TEXT = re.compile(r'https?://\S+|www\.\S+|[\w.+-]+@[\w-]+\.[\w.]+|[@#]\w+|\d+')
+NON_LETTERS = re.compile(r'[\W\d_]+')
+
+
+def has_words(text: str) -> bool:
+    """Есть ли в тексте слова (не только числа, ссылки, знаки и эмодзи)"""
+    return any(ch.isalpha() for ch in NON_TEXT.sub(' ', text))
+
+
+def detect_language(text: str, min_margin: float = MIN_MARGIN):
+    """Язык текста (название как в translation.LANGUAGES) или None, если не уверены
+
+    Сначала письменность, затем характерные буквы, затем частые триграммы.
+    min_margin - во сколько раз лучший язык должен опережать второй.
+    """
+    sample = NON_TEXT.sub(' ', text[:SAMPLE_CHARS]).lower()
+    chars = Counter(sample)
+    # Письменность по различным символам текста - их немного
+    counts = {name: 0 for name, *_ in SCRIPTS}
+    for ch, count in chars.items():
+        code = ord(ch)
+        for name, first, last, _ in SCRIPTS:
+            if first <= code <= last:
+                if ch.isalpha():
+                    counts[name] += count
+                break
+    script = max(counts, key=counts.get)
+    if not counts[script]:
+        return None
+    # В японском тексте много иероглифов, но кана выдает язык
+    if script == 'CJK' and counts['KANA']:
+        return 'японский'
+    if script not in ('LATIN', 'CYRILLIC'):
+        return next(language for name, _, _, language in SCRIPTS if name == script)
+
+    scores = dict.fromkeys(CYRILLIC if script == 'CYRILLIC' else LATIN, 0)
+    for ch in MARKERS.keys() & chars.keys():
+        for language in MARKERS[ch]:
+            if language in scores:
+                scores[language] += MARKER_WEIGHT * chars[ch]
+    if script == 'CYRILLIC' and 'ъ' in chars:
+        scores['болгарский'] += MARKER_WEIGHT * len(BULGARIAN_HARD_SIGN.findall(sample))
+    # Вклад характерных букв - до триграмм
+    markers = dict(scores)
+    words = ' ' + ' '.join(NON_LETTERS.sub(' ', sample).split()) + ' '
+    table = GRAMS[script]
+    for i in range(len(words) - 2):
+        for language, weight in table.get(words[i:i + 3], ()):
+            scores[language] += weight
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (best, best_score), (_, second_score) = ranked[0], ranked[1]
+    # Без явного перевеса (в том числе кириллица без особых букв и частых
+    # сочетаний) язык не угадываем: перевод уйдет к AI
+    if best_score == 0 or best_score < second_score * min_margin:
+        return None
+    # Короткий текст и похожие на русский языки - только по характерным буквам
+    if (counts[script] < MIN_LETTERS or best in NEEDS_MARKERS) and not markers[best]:
+        return None
+    return best
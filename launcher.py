@@ -0,0 +1,65 @@
+import os
+import secrets
+import logging
+from telegram import Update
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler
+
+logger = logging.getLogger(__name__)
+
+# Способ получения обновлений: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+
+# Настройки webhook: публичный адрес, адрес и порт локального сервера, путь
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'webhook')
+
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+
+# Какие обновления нужны каждому типу обработчика
+HANDLER_UPDATES = {
+    CommandHandler: Update.MESSAGE,
+    MessageHandler: Update.MESSAGE,
+    CallbackQueryHandler: Update.CALLBACK_QUERY,
+}
+
+
+def allowed_updates(application: Application) -> list:
+    """Типы обновлений, для которых зарегистрированы обработчики"""
+    types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            for handler_type, update_type in HANDLER_UPDATES.items():
+                if isinstance(handler, handler_type):
+                    types.add(update_type)
+    return sorted(types)
+
+
+def run(application: Application, updates: list = None):
+    """Запуск бота в режиме polling или webhook"""
+    if updates is None:
+        updates = allowed_updates(application)
+    logger.info("Получаем обновления: %s", ', '.join(updates))
+
+    if BOT_MODE != 'webhook':
+        application.run_polling(allowed_updates=updates)
+        return
+
+    if not WEBHOOK_URL:
+        logger.error("WEBHOOK_URL не задан - webhook режим невозможен")
+        return
+
+    # Без заданного секрета генерируем случайный на каждый запуск
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    logger.info("Webhook: %s:%s/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        secret_token=secret,
+        allowed_updates=updates
+    )
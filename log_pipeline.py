@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+# Уровень логирования
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Формат записей: json (по строке JSON на запись) или text
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+
+# Сколько записей ждут записи в stderr; при переполнении новые отбрасываются
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# Одинаковые предупреждения и ошибки: не больше LOG_SAMPLE_BURST за LOG_SAMPLE_WINDOW
+# секунд, остальные считаются и попадают в поле suppressed следующей записи
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', '5'))
+LOG_SAMPLE_WINDOW = float(os.getenv('LOG_SAMPLE_WINDOW', '60'))
+
+# Сколько разных повторяющихся записей помнит прореживание (давно не встречавшиеся забываются)
+LOG_SAMPLE_KEYS = 1000
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Поля записи в JSON, кроме сообщения
+FIELDS = ('user_id', 'mode', 'provider', 'latency', 'suppressed', 'dropped')
+
+_context = contextvars.ContextVar('log_context', default={})
+
+
+@contextmanager
+def log_context(**fields):
+    """Поля (user_id, mode, ...) для всех записей внутри блока и запущенных из него задач"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Поля log_context в запись - в потоке, где она создана"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, value in _context.get().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Повторы одного предупреждения или ошибки (шаблон + тип исключения) прореживаются"""
+
+    def __init__(self, burst: int = LOG_SAMPLE_BURST, window: float = LOG_SAMPLE_WINDOW,
+                 max_keys: int = LOG_SAMPLE_KEYS):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.max_keys = max_keys
+        # ключ -> [начало окна, записей в окне, пропущено] в порядке последней записи
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or not self.burst:
+            return True
+        args = record.args if isinstance(record.args, tuple) else ()
+        key = (
+            record.name, record.levelno, str(record.msg),
+            tuple(type(arg).__name__ for arg in args if isinstance(arg, BaseException)),
+            record.exc_info[0] if record.exc_info else None,
+        )
+        now = time.monotonic()
+        with self.lock:
+            state = self.seen.get(key)
+            if state is not None:
+                self.seen.move_to_end(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                self.seen[key] = [now, 1, 0]
+                if len(self.seen) > self.max_keys:
+                    self.seen.popitem(last=False)
+            elif state[1] < self.burst:
+                state[1] += 1
+                suppressed = 0
+            else:
+                state[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """Запись уходит в очередь без форматирования - строку собирает поток записи"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.dropped:
+            record.dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.dropped = 0
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись в одну строку JSON: время, уровень, логгер, сообщение и поля запроса"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for name in FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """Логирование через очередь и фоновый поток записи в stderr
+
+    Как logging.basicConfig, ничего не меняет, если корневой логгер уже
+    настроен. Возвращает запущенный QueueListener (или None).
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    handler = LazyQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(SamplingFilter())
+    handler.addFilter(ContextFilter())
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = QueueListener(handler.queue, output)
+    listener.start()
+    # Остаток очереди дописывается при завершении процесса
+    atexit.register(listener.stop)
+    return listener
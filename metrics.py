@@ -0,0 +1,220 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Адрес и порт для /metrics (0 - выключено). В режиме шардирования
+# каждый обработчик слушает METRICS_PORT + номер обработчика
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Границы корзин гистограмм задержки (секунды)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.function = None
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Значение вычисляется в момент чтения метрик"""
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, '', self.function()
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, key, f'le="{bound}"'), bucket_count
+            yield f"{self.name}_bucket", _format_labels(self.labelnames, key, 'le="+Inf"'), count
+            yield f"{self.name}_sum", _format_labels(self.labelnames, key), total
+            yield f"{self.name}_count", _format_labels(self.labelnames, key), count
+
+
+# Запросы пользователей по режимам
+REQUESTS = Counter('bot_requests_total', 'Обработанные сообщения по режимам', ('mode',))
+REQUEST_SECONDS = Histogram('bot_request_seconds', 'Время обработки сообщения', ('mode',))
+IN_FLIGHT = Gauge('bot_requests_in_flight', 'Сообщения в обработке', ('mode',))
+ERRORS = Counter('bot_errors_total', 'Ошибки обработки по типам', ('mode', 'type'))
+ACTIVE_SESSIONS = Gauge('bot_active_sessions', 'Сессии пользователей в памяти')
+IMAGE_JOBS = Gauge('bot_image_jobs', 'Задания на генерацию изображений', ('state',))
+
+# Запросы к AI провайдерам
+AI_REQUESTS = Counter('ai_requests_total', 'Запросы к AI провайдерам', ('provider', 'kind'))
+AI_REQUEST_SECONDS = Histogram('ai_request_seconds', 'Время ответа AI провайдера', ('provider', 'kind'))
+AI_ERRORS = Counter('ai_errors_total', 'Ошибки AI провайдеров по типам', ('provider', 'type'))
+AI_FIRST_TOKEN_SECONDS = Histogram('ai_first_token_seconds', 'Время до первого токена в потоковом режиме', ('provider',))
+AI_TOKENS = Counter('ai_tokens_total', 'Токены по данным провайдера (usage), для потока без usage - оценка', ('provider', 'direction'))
+AI_TIERS = Counter('ai_tier_requests_total', 'Запросы к AI по выбранной модели (fast/main)', ('mode', 'tier'))
+
+
+@contextmanager
+def track_request(mode: str):
+    """Учет сообщения: количество, время, ошибки, сколько сейчас в обработке"""
+    mode = mode or 'none'
+    started = time.monotonic()
+    IN_FLIGHT.inc(mode=mode)
+    try:
+        yield
+    except BaseException as e:
+        ERRORS.inc(mode=mode, type=type(e).__name__)
+        raise
+    finally:
+        IN_FLIGHT.dec(mode=mode)
+        REQUESTS.inc(mode=mode)
+        REQUEST_SECONDS.observe(time.monotonic() - started, mode=mode)
+
+
+@contextmanager
+def track_ai(provider: str, kind: str):
+    """Учет запроса к AI провайдеру (отмененные дублирующие запросы - не ошибка)"""
+    started = time.monotonic()
+    try:
+        yield
+    except asyncio.CancelledError:
+        raise
+    except BaseException as e:
+        AI_ERRORS.inc(provider=provider, type=type(e).__name__)
+        raise
+    finally:
+        AI_REQUESTS.inc(provider=provider, kind=kind)
+        AI_REQUEST_SECONDS.observe(time.monotonic() - started, provider=provider, kind=kind)
+
+
+def record_usage(provider: str, usage):
+    """Учет токенов из response.usage (объект SDK или словарь - в фрагментах потока старых версий SDK)"""
+    if usage is None:
+        return
+    if isinstance(usage, dict):
+        record_tokens(provider, usage.get('prompt_tokens') or 0, usage.get('completion_tokens') or 0)
+    else:
+        record_tokens(provider, usage.prompt_tokens or 0, usage.completion_tokens or 0)
+
+
+def record_tokens(provider: str, prompt: int, completion: int):
+    """Учет токенов запроса и ответа (из usage или оценка)"""
+    AI_TOKENS.inc(prompt, provider=provider, direction='prompt')
+    AI_TOKENS.inc(completion, provider=provider, direction='completion')
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # Заголовки запроса не нужны - дочитываем до пустой строки
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', render().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_metrics_server():
+    """Запуск HTTP сервера /metrics (если задан METRICS_PORT)"""
+    if not METRICS_PORT:
+        return None
+    port = METRICS_PORT + int(os.getenv('SHARD_INDEX', '0'))
+    server = await asyncio.start_server(_handle, METRICS_HOST, port)
+    logger.info("Метрики: http://%s:%s/metrics", METRICS_HOST, port)
+    return server
@@ -0,0 +1,139 @@
+import os
+import re
+import asyncio
+from collections import OrderedDict
+
+# Режимы, где почти одинаковые тексты получают уже готовый ответ
+NEAR_DUP_MODES = {
+    mode.strip() for mode in os.getenv('NEAR_DUP_MODES', 'summary,ideas').split(',') if mode.strip()
+}
+
+# Порог сходства отпечатков (0.95 - различаются не больше 3 бит из 64), 1 - только
+# тексты, совпадающие без учета регистра, эмодзи и знаков препинания
+NEAR_DUP_THRESHOLD = float(os.getenv('NEAR_DUP_THRESHOLD', '0.95'))
+
+# Сколько отпечатков хранить (около 500 байт на запись)
+NEAR_DUP_MAX_ENTRIES = int(os.getenv('NEAR_DUP_MAX_ENTRIES', '100000'))
+
+# Короче этого (в словах) тексты сравниваются только целиком: в коротком
+# тексте одно слово меняет смысл
+NEAR_DUP_MIN_WORDS = int(os.getenv('NEAR_DUP_MIN_WORDS', '30'))
+
+# Отпечаток текста длиннее (символы) считается в фоновом потоке - документ
+# в сотни КБ иначе задержал бы цикл событий на десятки миллисекунд
+SIMHASH_INLINE_CHARS = 4096
+
+BITS = 64
+MASK = (1 << BITS) - 1
+SHINGLE = 2
+
+WORDS = re.compile(r'\w+')
+
+
+def simhash(text: str):
+    """64-битный SimHash по парам слов -> (отпечаток, число слов)
+
+    Регистр, эмодзи, кавычки и пунктуация не влияют на отпечаток,
+    а небольшая правка текста меняет лишь несколько бит.
+    """
+    words = WORDS.findall(text.lower())
+    if len(words) < SHINGLE:
+        shingles = [' '.join(words)]
+    else:
+        shingles = [' '.join(words[i:i + SHINGLE]) for i in range(len(words) - SHINGLE + 1)]
+
+    # hash() строк свой в каждом процессе - отпечатки живут только в памяти
+    # Биты хэшей столбцами: подсчет единиц идет в C, а не по биту в Python
+    rows = [format(hash(shingle) & MASK, '064b') for shingle in shingles]
+    half = len(rows) / 2
+    fingerprint = 0
+    for column in zip(*rows):
+        fingerprint = (fingerprint << 1) | (column.count('1') > half)
+    return fingerprint, len(words)
+
+
+async def fingerprint(text: str):
+    """simhash(text), для длинного текста - в фоновом потоке"""
+    if len(text) <= SIMHASH_INLINE_CHARS:
+        return simhash(text)
+    return await asyncio.to_thread(simhash, text)
+
+
+class NearDuplicateIndex:
+    """Поиск почти одинаковых текстов по SimHash
+
+    Отпечаток делится на max_distance + 1 полос: у отпечатков, различающихся
+    не больше чем в max_distance битах, хотя бы одна полоса совпадает целиком.
+    Поиск проверяет только записи из тех же корзин, поэтому не зависит от
+    размера индекса. Старые записи вытесняются (LRU).
+
+    Методы принимают готовый отпечаток текста: simhash(text) или fingerprint(text).
+    """
+
+    def __init__(self, threshold: float = NEAR_DUP_THRESHOLD, max_entries: int = NEAR_DUP_MAX_ENTRIES,
+                 min_words: int = NEAR_DUP_MIN_WORDS):
+        self.max_distance = min(max(int((1 - threshold) * BITS + 1e-9), 0), BITS // 4)
+        self.max_entries = max_entries
+        self.min_words = min_words
+        bands = self.max_distance + 1
+        width = BITS // bands
+        self.bands = [
+            (i * width, (1 << (BITS - i * width if i == bands - 1 else width)) - 1) for i in range(bands)
+        ]
+        # (пространство, отпечаток) -> значение; пространство разделяет режимы и модели
+        self.entries = OrderedDict()
+        # пространство -> по словарю на полосу: значение полосы -> отпечатки
+        self.tables = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _buckets(self, namespace: str, fingerprint: int):
+        tables = self.tables.get(namespace, ())
+        return [(table, (fingerprint >> shift) & mask) for table, (shift, mask) in zip(tables, self.bands)]
+
+    def find(self, namespace: str, signature: tuple):
+        """Значение, сохраненное для похожего текста, или None"""
+        if not self.max_entries:
+            return None
+        fingerprint, words = signature
+        if (namespace, fingerprint) in self.entries:
+            self.entries.move_to_end((namespace, fingerprint))
+            return self.entries[(namespace, fingerprint)]
+        if words < self.min_words or not self.max_distance:
+            return None
+
+        best, best_distance = None, self.max_distance + 1
+        for table, band in self._buckets(namespace, fingerprint):
+            for candidate in table.get(band, ()):
+                distance = bin(candidate ^ fingerprint).count('1')
+                if distance < best_distance:
+                    best, best_distance = candidate, distance
+        if best is None:
+            return None
+        self.entries.move_to_end((namespace, best))
+        return self.entries[(namespace, best)]
+
+    def add(self, namespace: str, signature: tuple, value):
+        """Запоминание value для текста с отпечатком signature"""
+        if not self.max_entries:
+            return
+        fingerprint, _ = signature
+        entry = (namespace, fingerprint)
+        if entry not in self.entries:
+            if namespace not in self.tables:
+                self.tables[namespace] = [{} for _ in self.bands]
+            for table, band in self._buckets(namespace, fingerprint):
+                table.setdefault(band, []).append(fingerprint)
+        self.entries[entry] = value
+        self.entries.move_to_end(entry)
+        while len(self.entries) > self.max_entries:
+            self._evict()
+
+    def _evict(self):
+        (namespace, fingerprint), _ = self.entries.popitem(last=False)
+        for table, band in self._buckets(namespace, fingerprint):
+            bucket = table[band]
+            bucket.remove(fingerprint)
+            if not bucket:
+                del table[band]
@@ -0,0 +1,144 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import BaseRateLimiter
+from sharding import SHARD_WORKERS
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: всего в секунду, в один личный чат, в одну группу (на весь бот:
+# при SHARD_WORKERS > 1 общий и групповой лимиты делятся между обработчиками)
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_GROUP_RATE = float(os.getenv('SEND_GROUP_RATE', str(20 / 60)))
+
+# Сколько сообщений подряд можно отправить в чат без пауз
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', '3'))
+
+# Сколько раз повторять запрос после RetryAfter
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '3'))
+
+# Лимит Telegram на длину сообщения
+MAX_MESSAGE_LENGTH = 4096
+
+# Границы для разбиения: абзац, строка, предложение, слово
+SPLIT_PATTERNS = (re.compile(r'\n\s*\n'), re.compile(r'\n'), re.compile(r'(?<=[.!?…])\s'), re.compile(r'\s'))
+
+
+def retry_seconds(error: RetryAfter) -> float:
+    """Время ожидания из RetryAfter в секундах"""
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list:
+    """Разбиение длинного текста на сообщения по границам абзацев и предложений"""
+    parts = []
+    while len(text) > limit:
+        cut = 0
+        for pattern in SPLIT_PATTERNS:
+            # Последняя граница в пределах лимита, но не в самом начале
+            for match in pattern.finditer(text, limit // 2, limit):
+                cut = match.end()
+            if cut:
+                break
+        if not cut:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+
+async def send_answer(message, text: str, status=None):
+    """Отправка ответа частями; сообщение-статус ("⏳ ...") заменяется первой частью"""
+    parts = split_message(text)
+    first, rest = parts[0], parts[1:]
+    sent = None
+    if status is not None:
+        try:
+            sent = await status.edit_text(first)
+        except BadRequest:
+            sent = None
+    if sent is None:
+        sent = await message.reply_text(first)
+    for part in rest:
+        sent = await message.reply_text(part)
+    return sent
+
+
+class OutboxRateLimiter(BaseRateLimiter):
+    """Очередь исходящих запросов к Bot API с лимитами Telegram
+
+    Каждый запрос с chat_id занимает место в общей очереди и в очереди
+    своего чата (GCRA: равномерный темп с небольшим запасом на всплески).
+    При RetryAfter чат ставится на паузу, запрос повторяется.
+
+    Очередь своя в каждом процессе, поэтому обработчику достается доля
+    общего лимита: личный чат обслуживает один обработчик, а сообщения
+    в группу и общий поток идут из всех.
+    """
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE / SHARD_WORKERS, chat_rate: float = SEND_CHAT_RATE,
+                 group_rate: float = SEND_GROUP_RATE / SHARD_WORKERS, burst: int = SEND_CHAT_BURST,
+                 max_retries: int = SEND_MAX_RETRIES):
+        self.global_interval = 1 / global_rate
+        self.chat_interval = 1 / chat_rate
+        self.group_interval = 1 / group_rate
+        self.burst = burst
+        self.global_burst = max(1, int(global_rate))
+        self.max_retries = max_retries
+        self.next_slot = {}
+        self.delayed = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _reserve(self, key, interval: float, burst: int) -> float:
+        """Место в очереди: через сколько секунд можно отправлять"""
+        now = time.monotonic()
+        slot = max(self.next_slot.get(key, 0.0), now - (burst - 1) * interval)
+        self.next_slot[key] = slot + interval
+        return max(0.0, slot - now)
+
+    def _cleanup(self):
+        now = time.monotonic()
+        self.next_slot = {key: slot for key, slot in self.next_slot.items() if slot > now}
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+
+        is_group = isinstance(chat_id, str) or chat_id < 0
+        interval = self.group_interval if is_group else self.chat_interval
+        for attempt in range(self.max_retries + 1):
+            # Сначала очередь чата, затем общая - чтобы не занимать общее место впустую
+            wait = self._reserve(('chat', chat_id), interval, self.burst)
+            if wait:
+                self.delayed += 1
+                await asyncio.sleep(wait)
+            wait = self._reserve('global', self.global_interval, self.global_burst)
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                pause = retry_seconds(e)
+                logger.info("Telegram просит паузу %.1f c для чата %s", pause, chat_id)
+                key = ('chat', chat_id)
+                self.next_slot[key] = max(self.next_slot.get(key, 0.0), time.monotonic() + pause)
+            finally:
+                if len(self.next_slot) > 10000:
+                    self._cleanup()
@@ -0,0 +1,184 @@
+import os
+import time
+import random
+import asyncio
+import contextvars
+from contextlib import contextmanager
+import httpx
+from scheduler import RateLimited
+
+# Сквозной дедлайн обработки сообщения по режимам (секунды), вместе с повторами
+AI_DEADLINES = {
+    mode.strip(): float(seconds)
+    for mode, _, seconds in (
+        item.partition('=') for item in
+        os.getenv('AI_DEADLINES', 'chat=60,translate=30,summary=120,ideas=45,image=120').split(',')
+    )
+    if mode.strip() and seconds.strip()
+}
+
+# Сколько попыток запроса к AI (вместе с первой)
+AI_RETRY_ATTEMPTS = int(os.getenv('AI_RETRY_ATTEMPTS', '3'))
+
+# Пауза перед повтором растет вдвое от AI_RETRY_BASE_DELAY до AI_RETRY_MAX_DELAY (секунды),
+# со случайным разбросом; Retry-After провайдера важнее
+AI_RETRY_BASE_DELAY = float(os.getenv('AI_RETRY_BASE_DELAY', '0.2'))
+AI_RETRY_MAX_DELAY = float(os.getenv('AI_RETRY_MAX_DELAY', '5'))
+
+# Ошибки клиента, которые не говорят о неисправности провайдера
+CLIENT_ERRORS = {400, 404, 413, 422}
+
+_deadline = contextvars.ContextVar('ai_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """AI не ответил за время, отведенное на сообщение"""
+
+    def __init__(self, message: str = "AI не ответил вовремя"):
+        super().__init__(message)
+
+
+class ProviderUnavailable(RateLimited):
+    """Все провайдеры отключены предохранителем - запрос не отправляется"""
+
+
+@contextmanager
+def deadline(mode: str):
+    """Дедлайн для всех запросов к AI внутри блока (и запущенных из него задач)"""
+    seconds = AI_DEADLINES.get(mode)
+    if not seconds:
+        yield
+        return
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def extend_deadline(seconds: float):
+    """Дедлайн не раньше чем через seconds - для долгих задач с известным объемом работы"""
+    expires = _deadline.get()
+    if expires is None:
+        yield
+        return
+    token = _deadline.set(max(expires, time.monotonic() + seconds))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left():
+    """Сколько секунд осталось до дедлайна (None - дедлайна нет)"""
+    expires = _deadline.get()
+    return None if expires is None else expires - time.monotonic()
+
+
+def attempt_timeout(attempts_left: int):
+    """Время на попытку: остаток дедлайна делится на оставшиеся попытки"""
+    left = time_left()
+    if left is None:
+        return None
+    return max(left, 0.0) / max(attempts_left, 1)
+
+
+def _status(error: BaseException):
+    return getattr(error, 'status_code', None)
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Временная ошибка: 429, 5xx, таймаут или обрыв соединения"""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    status = _status(error)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    # openai.APIConnectionError и APITimeoutError - без импорта SDK
+    return any(cls.__name__ == 'APIConnectionError' for cls in type(error).__mro__)
+
+
+def is_provider_failure(error: BaseException) -> bool:
+    """Ошибка провайдера, а не запроса: учитывается предохранителем"""
+    return _status(error) not in CLIENT_ERRORS
+
+
+def retry_after(error: BaseException):
+    """Пауза из заголовков Retry-After-Ms / Retry-After ответа (секунды или None)"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    for name, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+def backoff(attempt: int, hint: float = None) -> float:
+    """Пауза перед повтором номер attempt: экспонента со случайным разбросом"""
+    delay = random.uniform(0, min(AI_RETRY_MAX_DELAY, AI_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+    if hint is not None:
+        # Не раньше, чем просит провайдер, но с разбросом, чтобы повторы не совпали
+        delay = hint + delay / 2
+    return delay
+
+
+class CircuitBreaker:
+    """Предохранитель провайдера: closed -> open -> half-open -> closed
+
+    Доля ошибок (скользящее среднее) выше порога размыкает его на cooldown
+    секунд - запросы к провайдеру сразу отклоняются. Затем пропускается
+    одна пробная попытка: успех замыкает предохранитель, ошибка - снова
+    размыкает.
+    """
+
+    __slots__ = ('max_error_rate', 'cooldown', 'error_rate', 'opened', 'probing')
+
+    def __init__(self, max_error_rate: float, cooldown: float):
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.error_rate = 0.0
+        self.opened = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened is None:
+            return 'closed'
+        return 'half-open' if self.probing or self.reopens_in() == 0 else 'open'
+
+    def reopens_in(self) -> float:
+        """Через сколько секунд будет пропущена пробная попытка"""
+        if self.opened is None:
+            return 0.0
+        return max(0.0, self.opened + self.cooldown - time.monotonic())
+
+    def available(self) -> bool:
+        return self.opened is None or (not self.probing and self.reopens_in() == 0)
+
+    def acquire(self) -> bool:
+        """Можно ли отправить запрос (после паузы - одна пробная попытка)"""
+        if self.opened is None:
+            return True
+        if self.probing or self.reopens_in() > 0:
+            return False
+        self.probing = True
+        return True
+
+    def release(self):
+        """Попытка отменена без результата"""
+        self.probing = False
+
+    def record(self, error: bool):
+        self.error_rate = self.error_rate * 0.9 + (0.1 if error else 0.0)
+        if error:
+            if self.probing or self.error_rate >= self.max_error_rate:
+                self.opened = time.monotonic()
+        elif self.opened is not None:
+            self.opened = None
+            self.error_rate = 0.0
+        self.probing = False
@@ -0,0 +1,280 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from near_duplicates import NEAR_DUP_MODES, NearDuplicateIndex, fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Режимы, ответы которых кэшируются (остальные всегда идут к AI)
+CACHE_MODES = {
+    mode.strip() for mode in os.getenv('CACHE_MODES', 'translate,summary,ideas').split(',') if mode.strip()
+}
+
+# Размер кэша в памяти и время жизни записей (секунды)
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '1000'))
+CACHE_TTL = float(os.getenv('CACHE_TTL', '86400'))
+
+# Файл SQLite для второго уровня кэша (пусто - только память)
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH', '')
+
+# Сколько записей хранить на диске (в каждой таблице); старые удаляются
+CACHE_DISK_MAX_ENTRIES = int(os.getenv('CACHE_DISK_MAX_ENTRIES', '100000'))
+
+# Через сколько записей удалять с диска устаревшие и лишние ответы
+CACHE_PURGE_EVERY = 1000
+
+
+def normalize_text(text: str) -> str:
+    """Нормализация текста запроса: лишние пробелы и переводы строк"""
+    return ' '.join(text.split())
+
+
+def make_key(mode: str, text: str, model: str, max_tokens: int) -> str:
+    """Ключ кэша: режим + нормализованный текст + модель + max_tokens"""
+    raw = f"{mode}\x00{model}\x00{max_tokens}\x00{normalize_text(text)}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class DiskCache:
+    """Второй уровень кэша в SQLite
+
+    У каждого кэша своя таблица (свой TTL). Каждые CACHE_PURGE_EVERY записей
+    удаляются устаревшие строки и самые старые сверх max_entries, чтобы файл
+    не рос бесконечно.
+    """
+
+    def __init__(self, path: str, ttl: float, table: str = 'responses',
+                 max_entries: int = CACHE_DISK_MAX_ENTRIES):
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.table = table
+        self.max_entries = max_entries
+        self.writes = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)")
+        self.db.commit()
+        self.purge()
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.db.execute(
+                f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return row[0], row[1]
+
+    def set(self, key: str, value: str, created: float):
+        with self.lock:
+            self.db.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created) VALUES (?, ?, ?)",
+                (key, value, created)
+            )
+            self.db.commit()
+            self.writes += 1
+            if self.writes % CACHE_PURGE_EVERY:
+                return
+        self.purge()
+
+    def delete(self, key: str):
+        with self.lock:
+            self.db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self.db.commit()
+
+    def purge(self) -> int:
+        """Удаление устаревших записей и самых старых сверх max_entries"""
+        with self.lock:
+            removed = self.db.execute(
+                f"DELETE FROM {self.table} WHERE created < ?", (time.time() - self.ttl,)
+            ).rowcount
+            extra = self.db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0] - self.max_entries
+            if extra > 0:
+                removed += self.db.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY created LIMIT ?)", (extra,)
+                ).rowcount
+            self.db.commit()
+        if removed:
+            logger.info("Кэш на диске (%s): удалено записей %d", self.table, removed)
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class SingleFlight:
+    """Объединение одинаковых запросов, выполняющихся одновременно
+
+    Первый запрос по ключу запускает общую задачу, остальные ждут ее
+    результат. Отмена ожидающего не отменяет общую задачу, пока ее ждет
+    кто-то еще; ушел последний - запрос к AI прерывается.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.waiters = {}
+        self.coalesced = 0
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        # Ошибку могли не забрать, если все ожидающие отменены
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: str, factory):
+        """Результат factory() - общий для всех одновременных вызовов с ключом key"""
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.coalesced += 1
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self.waiters[task] == 1:
+                task.cancel()
+                # Новый вызов с тем же ключом не должен присоединиться к отменяемой задаче
+                if self.calls.get(key) is task:
+                    del self.calls[key]
+            raise
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+
+
+class ResponseCache:
+    """Кэш ответов: LRU с TTL в памяти + необязательный уровень на диске"""
+
+    def __init__(self, modes=CACHE_MODES, max_entries: int = CACHE_MAX_ENTRIES,
+                 ttl: float = CACHE_TTL, db_path: str = CACHE_DB_PATH, near_modes=NEAR_DUP_MODES,
+                 db_table: str = 'responses'):
+        self.modes = set(modes)
+        self.near_modes = set(near_modes) & self.modes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = SingleFlight()
+        self.disk = DiskCache(db_path, ttl, db_table) if db_path else None
+        self.near = NearDuplicateIndex()
+        self.hits = 0
+        self.disk_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def enabled_for(self, mode: str) -> bool:
+        return mode in self.modes and self.max_entries > 0
+
+    def _remember(self, key: str, value: str, created: float):
+        self.entries[key] = (value, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def _lookup(self, key: str):
+        """Ответ по ключу из памяти или с диска и уровень, где он найден"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            if time.time() - entry[1] <= self.ttl:
+                self.entries.move_to_end(key)
+                return entry[0], 'memory'
+            del self.entries[key]
+
+        if self.disk is not None:
+            entry = await asyncio.to_thread(self.disk.get, key)
+            if entry is not None:
+                self._remember(key, *entry)
+                return entry[0], 'disk'
+        return None, None
+
+    async def get(self, mode: str, text: str, model: str, max_tokens: int, source: str = None):
+        """Готовый ответ из кэша или None
+
+        source - исходный текст пользователя без инструкции: для режимов
+        near_modes подходит и ответ на почти такой же текст.
+        """
+        if not self.enabled_for(mode):
+            return None
+
+        value, level = await self._lookup(make_key(mode, text, model, max_tokens))
+        if level == 'memory':
+            self.hits += 1
+            return value
+        if level == 'disk':
+            self.disk_hits += 1
+            return value
+
+        if source and mode in self.near_modes and self.near.max_entries:
+            key = self.near.find(f"{mode}\x00{model}\x00{max_tokens}", await fingerprint(source))
+            if key is not None:
+                value, _ = await self._lookup(key)
+                if value is not None:
+                    self.near_hits += 1
+                    return value
+
+        self.misses += 1
+        return None
+
+    async def set(self, mode: str, text: str, model: str, max_tokens: int, value: str, source: str = None):
+        """Сохранение ответа в кэш"""
+        if not self.enabled_for(mode) or not value:
+            return
+
+        key = make_key(mode, text, model, max_tokens)
+        created = time.time()
+        self._remember(key, value, created)
+        if source and mode in self.near_modes and self.near.max_entries:
+            self.near.add(f"{mode}\x00{model}\x00{max_tokens}", await fingerprint(source), key)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.set, key, value, created)
+
+    async def forget(self, mode: str, text: str, model: str, max_tokens: int):
+        """Удаление устаревшего ответа из кэша"""
+        key = make_key(mode, text, model, max_tokens)
+        self.entries.pop(key, None)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.delete, key)
+
+    async def compute(self, mode: str, text: str, model: str, max_tokens: int, factory, source: str = None):
+        """Ответ от factory() с объединением одинаковых запросов и записью в кэш"""
+        key = make_key(mode, text, model, max_tokens)
+
+        async def run():
+            value = await factory()
+            await self.set(mode, text, model, max_tokens, value, source)
+            return value
+
+        return await self.inflight.do(key, run)
+
+    def stats(self) -> dict:
+        found = self.hits + self.disk_hits + self.near_hits
+        total = found + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses,
+            'hit_rate': found / total if total else 0.0,
+            'entries': len(self.entries),
+            'near_entries': len(self.near),
+            'coalesced': self.inflight.coalesced,
+        }
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
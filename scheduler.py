@@ -0,0 +1,187 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# Режимы, которые обращаются к AI провайдеру
+AI_MODES = {'chat', 'image', 'translate', 'summary', 'ideas'}
+
+# Общий лимит одновременных запросов к AI
+AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', '32'))
+
+# Лимит на пользователя: USER_RATE запросов в секунду, запас USER_BURST
+USER_RATE = float(os.getenv('USER_RATE', '0.2'))
+USER_BURST = float(os.getenv('USER_BURST', '5'))
+
+# Сколько запросов одного пользователя может ждать в очереди
+USER_MAX_QUEUED = int(os.getenv('USER_MAX_QUEUED', '2'))
+
+# Общий размер очереди, сверх которого запросы сразу отклоняются
+SCHEDULER_MAX_QUEUE = int(os.getenv('SCHEDULER_MAX_QUEUE', '500'))
+
+# Сколько корзин хранить до очистки неактивных
+MAX_BUCKETS = 10000
+
+
+class RateLimited(Exception):
+    """Запрос отклонен без обращения к AI"""
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> float:
+        """Взять токен: 0 если успешно, иначе сколько секунд ждать"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class FairScheduler:
+    """Допуск запросов к AI: лимиты пользователей и справедливая очередь
+
+    Свободные места раздаются пользователям по кругу, поэтому один активный
+    пользователь не может занять всю очередь.
+    """
+
+    def __init__(self, max_concurrency: int = AI_MAX_CONCURRENCY, rate: float = USER_RATE,
+                 burst: float = USER_BURST, max_queued_per_user: int = USER_MAX_QUEUED,
+                 max_queue: int = SCHEDULER_MAX_QUEUE, modes=AI_MODES):
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_queued_per_user = max_queued_per_user
+        self.max_queue = max_queue
+        self.modes = set(modes)
+        self.buckets = {}
+        self.queues = OrderedDict()
+        self.queued = 0
+        self.active = 0
+        self.rejected = 0
+
+    def _check_rate(self, user_id: int):
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                self.buckets = {uid: b for uid, b in self.buckets.items() if not b.is_full()}
+            bucket = self.buckets[user_id] = TokenBucket(self.rate, self.burst)
+        wait = bucket.try_take()
+        if wait:
+            self.rejected += 1
+            raise RateLimited("Слишком много запросов", retry_after=wait)
+
+    async def _acquire(self, user_id: int, limit_user: bool = True):
+        if self.active < self.max_concurrency and not self.queued:
+            self.active += 1
+            return
+
+        queue = self.queues.get(user_id)
+        if limit_user and queue is not None and len(queue) >= self.max_queued_per_user:
+            self.rejected += 1
+            raise RateLimited("Дождитесь ответа на предыдущие запросы")
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise RateLimited("Бот перегружен", retry_after=5.0)
+
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user_id, deque()).append(future)
+        self.queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Место уже выдано - возвращаем его следующему
+                self._release()
+            else:
+                self._discard(user_id, future)
+            raise
+
+    def _discard(self, user_id: int, future):
+        queue = self.queues.get(user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+            self.queued -= 1
+        except ValueError:
+            return
+        if not queue:
+            del self.queues[user_id]
+
+    def _release(self):
+        self.active -= 1
+        while self.active < self.max_concurrency and self.queues:
+            # Первый пользователь в круге получает место и уходит в конец
+            user_id, queue = next(iter(self.queues.items()))
+            future = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self.queues.move_to_end(user_id)
+            else:
+                del self.queues[user_id]
+            if not future.done():
+                future.set_result(None)
+                self.active += 1
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, mode: str):
+        """Место для запроса к AI (режимы без AI проходят без ограничений)"""
+        if mode not in self.modes:
+            yield
+            return
+
+        self._check_rate(user_id)
+        await self._acquire(user_id)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def subtask(self, user_id: int):
+        """Место для дополнительного запроса уже допущенного сообщения (фрагменты документа)
+
+        Без лимита частоты и очереди пользователя: сколько запросов нужно,
+        решает само сообщение, а справедливость между пользователями сохраняется.
+        """
+        await self._acquire(user_id, limit_user=False)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'rejected': self.rejected,
+        }
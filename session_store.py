@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Хранилище сессий: sqlite (по умолчанию) или memory (без сохранения)
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite').lower()
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+
+# Запись на диск пачками: раз в SESSION_FLUSH_INTERVAL секунд
+# или сразу, как только накопилось SESSION_FLUSH_BATCH измененных сессий
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', '2.0'))
+SESSION_FLUSH_BATCH = int(os.getenv('SESSION_FLUSH_BATCH', '100'))
+
+# Сессии без обращений дольше SESSION_IDLE_TIMEOUT секунд (0 - никогда) выгружаются из памяти
+# в хранилище и загружаются снова при следующем сообщении; в памяти держится
+# не больше SESSION_MAX_RESIDENT сессий (0 - без ограничения)
+SESSION_IDLE_TIMEOUT = float(os.getenv('SESSION_IDLE_TIMEOUT', '1800'))
+SESSION_MAX_RESIDENT = int(os.getenv('SESSION_MAX_RESIDENT', '10000'))
+
+# Сколько user_id без сохраненной сессии помнить, чтобы не искать их в хранилище снова
+SESSION_MISSING_CACHE = 10000
+
+# Роли сообщений истории хранятся номерами
+ROLES = ("user", "assistant", "system")
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+
+class History:
+    """История диалога: роли в bytearray, тексты в списке
+
+    Снаружи выглядит как список сообщений {"role": ..., "content": ...},
+    но не держит по словарю на каждое сообщение.
+    """
+
+    __slots__ = ('roles', 'contents')
+
+    def __init__(self, messages=()):
+        self.roles = bytearray()
+        self.contents = []
+        for message in messages:
+            self.append(message)
+
+    def append(self, message: dict):
+        self.roles.append(ROLE_CODES[message['role']])
+        self.contents.append(message['content'])
+
+    def __len__(self) -> int:
+        return len(self.contents)
+
+    def __iter__(self):
+        for code, content in zip(self.roles, self.contents):
+            yield {"role": ROLES[code], "content": content}
+
+    def __reversed__(self):
+        for index in range(len(self.contents) - 1, -1, -1):
+            yield {"role": ROLES[self.roles[index]], "content": self.contents[index]}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [{"role": ROLES[code], "content": content}
+                    for code, content in zip(self.roles[index], self.contents[index])]
+        return {"role": ROLES[self.roles[index]], "content": self.contents[index]}
+
+    def __delitem__(self, index):
+        del self.roles[index]
+        del self.contents[index]
+
+
+class Session:
+    """Сессия пользователя с фиксированным набором полей
+
+    Поддерживает обращение как к словарю (session['mode'], get, pop),
+    поле со значением None считается отсутствующим.
+    """
+
+    __slots__ = ('name', 'mode', 'messages_count', 'history', 'history_tokens', 'summary')
+
+    def __init__(self, data: dict = None):
+        for field in self.__slots__:
+            object.__setattr__(self, field, None)
+        for key, value in (data or {}).items():
+            self[key] = value
+
+    def __getitem__(self, key: str):
+        value = getattr(self, key) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        if key == 'history' and value is not None and not isinstance(value, History):
+            value = History(value)
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def get(self, key: str, default=None):
+        value = getattr(self, key) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def setdefault(self, key: str, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key: str, default=None):
+        value = self.get(key, default)
+        if key in self.__slots__:
+            setattr(self, key, None)
+        return value
+
+    def to_dict(self) -> dict:
+        data = {field: getattr(self, field) for field in self.__slots__ if getattr(self, field) is not None}
+        if 'history' in data:
+            data['history'] = list(data['history'])
+        return data
+
+
+class MemorySessionBackend:
+    """Сессии только в памяти процесса (выгруженные хранятся строкой JSON)"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def count(self) -> int:
+        return len(self.rows)
+
+    def load(self, user_id: int):
+        return self.rows.get(user_id)
+
+    def save_many(self, rows: list):
+        self.rows.update(rows)
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionBackend:
+    """Сессии в SQLite (режим WAL)"""
+
+    def __init__(self, path: str):
+        # Отдельные соединения: чтение из цикла событий, запись из фонового потока
+        self.writer = sqlite3.connect(path, check_same_thread=False)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("PRAGMA synchronous=NORMAL")
+        self.writer.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self.writer.commit()
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+
+    def count(self) -> int:
+        return self.reader.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def load(self, user_id: int):
+        row = self.reader.execute(
+            "SELECT data FROM sessions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save_many(self, rows: list):
+        now = time.time()
+        self.writer.executemany(
+            "INSERT INTO sessions (user_id, data, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+            [(user_id, data, now) for user_id, data in rows]
+        )
+        self.writer.commit()
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+def create_backend(name: str = SESSION_BACKEND, path: str = SESSION_DB_PATH):
+    """Создание хранилища сессий по имени"""
+    if name == 'memory':
+        return MemorySessionBackend()
+    if name == 'sqlite':
+        return SQLiteSessionBackend(path)
+    raise ValueError(f"Неизвестное хранилище сессий: {name}")
+
+
+class SessionStore:
+    """Сессии пользователей: кэш в памяти + отложенная пакетная запись
+
+    Ведет себя как словарь user_id -> Session. Любое обращение к
+    сессии помечает ее измененной (поля и история меняются на месте),
+    измененные сессии сохраняются в фоне пачками. В памяти остаются только
+    недавно активные сессии, остальные загружаются из хранилища по запросу
+    (preload - в фоновом потоке, до обработчиков).
+
+    in_use(user_id) - сессию держит обработчик (например, ждет ответа AI),
+    такие сессии не выгружаются: изменения после записи потерялись бы.
+    """
+
+    def __init__(self, backend=None, flush_interval: float = SESSION_FLUSH_INTERVAL,
+                 batch_size: int = SESSION_FLUSH_BATCH, idle_timeout: float = SESSION_IDLE_TIMEOUT,
+                 max_resident: int = SESSION_MAX_RESIDENT, in_use=None):
+        self.backend = backend if backend is not None else create_backend()
+        self.in_use = in_use or (lambda user_id: False)
+        # user_id, которых нет в хранилище (LRU): новый пользователь ищется там один раз
+        self.missing = OrderedDict()
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.max_resident = max_resident
+        # user_id -> Session в порядке последнего обращения
+        self.sessions = OrderedDict()
+        self.used = {}
+        self.dirty = set()
+        self.hibernated = 0
+        self.wakeup = None
+        self.flush_task = None
+        self.closing = False
+
+    def _touch(self, user_id: int):
+        self.sessions.move_to_end(user_id)
+        self.used[user_id] = time.monotonic()
+        self.dirty.add(user_id)
+        if self.wakeup is not None and (
+                len(self.dirty) >= self.batch_size or len(self.sessions) > self.max_resident > 0):
+            self.wakeup.set()
+
+    def _load(self, user_id: int):
+        if user_id in self.sessions:
+            return self.sessions[user_id]
+        if user_id in self.missing:
+            raise KeyError(user_id)
+        # Обычно хранилище уже проверил preload; здесь - обращение в обход него
+        data = self.backend.load(user_id)
+        if data is None:
+            self._missing(user_id)
+            raise KeyError(user_id)
+        return self._resident(user_id, data)
+
+    def _missing(self, user_id: int):
+        self.missing[user_id] = True
+        self.missing.move_to_end(user_id)
+        while len(self.missing) > SESSION_MISSING_CACHE:
+            self.missing.popitem(last=False)
+
+    def _resident(self, user_id: int, data: str) -> Session:
+        session = Session(json.loads(data))
+        self.sessions[user_id] = session
+        self.used[user_id] = time.monotonic()
+        return session
+
+    async def preload(self, user_id: int):
+        """Поиск сессии в хранилище в фоновом потоке, чтобы обработчик не ждал его"""
+        if user_id in self.sessions or user_id in self.missing:
+            return
+        data = await asyncio.to_thread(self.backend.load, user_id)
+        # Пока шло чтение, сессию могли создать или загрузить
+        if user_id in self.sessions:
+            return
+        if data is None:
+            self._missing(user_id)
+        else:
+            self._resident(user_id, data)
+
+    def __contains__(self, user_id) -> bool:
+        try:
+            self._load(user_id)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, user_id: int) -> Session:
+        session = self._load(user_id)
+        self._touch(user_id)
+        return session
+
+    def __setitem__(self, user_id: int, session):
+        self.sessions[user_id] = session if isinstance(session, Session) else Session(session)
+        self.missing.pop(user_id, None)
+        self._touch(user_id)
+
+    def get(self, user_id: int, default=None):
+        try:
+            return self[user_id]
+        except KeyError:
+            return default
+
+    def __len__(self) -> int:
+        """Число сессий в памяти и хранилище (новые могут быть еще не записаны)"""
+        return max(self.backend.count(), len(self.sessions))
+
+    async def start(self):
+        """Запуск фоновой записи (внутри цикла событий)"""
+        self.wakeup = asyncio.Event()
+        self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+                await self.hibernate()
+            except Exception as e:
+                logger.error("Ошибка сохранения сессий: %s", e)
+
+    async def flush(self):
+        """Запись измененных сессий одной транзакцией в фоновом потоке"""
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        # Сериализация в цикле событий - сессии не меняются во время записи
+        rows = self._rows(dirty)
+        try:
+            await asyncio.to_thread(self.backend.save_many, rows)
+        except BaseException:
+            self.dirty |= dirty
+            raise
+
+    def _rows(self, user_ids) -> list:
+        return [
+            (user_id, json.dumps(self.sessions[user_id].to_dict(), ensure_ascii=False))
+            for user_id in user_ids if user_id in self.sessions
+        ]
+
+    async def hibernate(self):
+        """Выгрузка давно неактивных сессий и сверх SESSION_MAX_RESIDENT из памяти
+
+        Сессия записывается целиком перед выгрузкой: обработчик мог изменить
+        ее уже после последней записи. Сессии, которые держат обработчики
+        (in_use), остаются в памяти.
+        """
+        cutoff = time.monotonic() - self.idle_timeout if self.idle_timeout > 0 else float('-inf')
+        excess = len(self.sessions) - self.max_resident if self.max_resident > 0 else 0
+        idle = []
+        # Сессии упорядочены по последнему обращению - самые старые в начале
+        for user_id in self.sessions:
+            if self.used[user_id] > cutoff and len(idle) >= excess:
+                break
+            if not self.in_use(user_id):
+                idle.append(user_id)
+        if not idle:
+            return
+
+        used = {user_id: self.used.get(user_id) for user_id in idle}
+        await asyncio.to_thread(self.backend.save_many, self._rows(idle))
+        for user_id in idle:
+            # Пока шла запись, к сессии могли обратиться - она остается в памяти
+            if user_id in self.sessions and self.used.get(user_id) == used[user_id]:
+                del self.sessions[user_id]
+                self.used.pop(user_id, None)
+                self.dirty.discard(user_id)
+                self.hibernated += 1
+
+    async def close(self):
+        """Остановка фоновой записи и сохранение оставшихся изменений"""
+        if self.flush_task is not None:
+            self.closing = True
+            self.wakeup.set()
+            await self.flush_task
+            self.flush_task = None
+        await self.flush()
+        self.backend.close()
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import multiprocessing
+from collections import deque
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+import launcher
+from http_pool import telegram_request
+
+logger = logging.getLogger(__name__)
+
+# Количество процессов-обработчиков (1 - один процесс, как раньше)
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '1'))
+
+# Локальный порт для связи с обработчиками (0 - любой свободный)
+SHARD_PORT = int(os.getenv('SHARD_PORT', '0'))
+
+# Обработчик шлет сигнал раз в SHARD_HEARTBEAT секунд,
+# без сигнала дольше SHARD_HEALTH_TIMEOUT он перезапускается
+SHARD_HEARTBEAT = float(os.getenv('SHARD_HEARTBEAT', '2'))
+SHARD_HEALTH_TIMEOUT = float(os.getenv('SHARD_HEALTH_TIMEOUT', '15'))
+
+# Сколько ждать готовности нового обработчика (загрузка модулей, прогрев соединений)
+SHARD_STARTUP_TIMEOUT = float(os.getenv('SHARD_STARTUP_TIMEOUT', '120'))
+
+# Сколько обновлений копить для обработчика, пока он перезапускается
+SHARD_MAX_PENDING = int(os.getenv('SHARD_MAX_PENDING', '1000'))
+
+IPC_HOST = '127.0.0.1'
+
+
+def shard_for(update: Update, workers: int) -> int:
+    """Номер обработчика: все обновления пользователя идут в один процесс"""
+    user = update.effective_user
+    return (user.id if user else 0) % workers
+
+
+async def _send(writer: asyncio.StreamWriter, message: dict):
+    writer.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+    await writer.drain()
+
+
+# ---------- Процесс-обработчик ----------
+
+def worker_main(build, token: str, index: int, port: int):
+    """Точка входа процесса-обработчика"""
+    # Номер обработчика - для отдельного порта метрик
+    os.environ['SHARD_INDEX'] = str(index)
+    asyncio.run(_worker(build, token, index, port))
+
+
+async def _worker(build, token: str, index: int, port: int):
+    application = build(token)
+    reader, writer = await asyncio.open_connection(IPC_HOST, port)
+    await _send(writer, {'type': 'hello', 'worker': index})
+
+    async def heartbeat():
+        while True:
+            await _send(writer, {'type': 'ping'})
+            await asyncio.sleep(SHARD_HEARTBEAT)
+
+    # Сигналы идут и во время прогрева: долгий запуск - не зависание
+    heartbeat_task = asyncio.create_task(heartbeat())
+
+    # initialize() не вызывает post_init/post_shutdown - вызываем сами
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    await _send(writer, {'type': 'ready'})
+    logger.info("Обработчик %d запущен (pid %d)", index, os.getpid())
+
+    try:
+        while line := await reader.readline():
+            data = json.loads(line)
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        # Процесс приема закрыл соединение - завершаемся
+        heartbeat_task.cancel()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+
+# ---------- Процесс приема обновлений ----------
+
+class ShardRouter:
+    """Раздача обновлений процессам-обработчикам по user_id"""
+
+    def __init__(self, build, token: str, workers: int = SHARD_WORKERS):
+        self.build = build
+        self.token = token
+        self.workers = workers
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = [None] * workers
+        self.writers = [None] * workers
+        self.last_seen = [0.0] * workers
+        self.ready = [False] * workers
+        self.pending = [deque(maxlen=SHARD_MAX_PENDING) for _ in range(workers)]
+        self.server = None
+        self.port = None
+        self.monitor_task = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._on_connect, IPC_HOST, SHARD_PORT)
+        self.port = self.server.sockets[0].getsockname()[1]
+        for index in range(self.workers):
+            self._spawn(index)
+        self.monitor_task = asyncio.create_task(self._monitor())
+
+    def _spawn(self, index: int):
+        process = self.context.Process(
+            target=worker_main,
+            args=(self.build, self.token, index, self.port),
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+        self.writers[index] = None
+        # До сообщения ready действует SHARD_STARTUP_TIMEOUT
+        self.ready[index] = False
+        self.last_seen[index] = time.monotonic()
+        logger.info("Запущен обработчик %d (pid %d)", index, process.pid)
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        hello = json.loads(await reader.readline())
+        index = hello['worker']
+        self.writers[index] = writer
+        self.last_seen[index] = time.monotonic()
+
+        # Обновления, пришедшие пока обработчик был недоступен
+        while self.pending[index] and self.writers[index] is writer:
+            writer.write(self.pending[index].popleft())
+        await writer.drain()
+
+        while line := await reader.readline():
+            self.last_seen[index] = time.monotonic()
+            if json.loads(line).get('type') == 'ready':
+                self.ready[index] = True
+        if self.writers[index] is writer:
+            self.writers[index] = None
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(SHARD_HEARTBEAT)
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                timeout = SHARD_HEALTH_TIMEOUT if self.ready[index] else SHARD_STARTUP_TIMEOUT
+                if process.is_alive() and now - self.last_seen[index] <= timeout:
+                    continue
+                logger.warning("Обработчик %d не отвечает - перезапуск", index)
+                if process.is_alive():
+                    process.kill()
+                await asyncio.to_thread(process.join, 5)
+                if self.writers[index] is not None:
+                    self.writers[index].close()
+                self._spawn(index)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Передача обновления обработчику его пользователя"""
+        index = shard_for(update, self.workers)
+        line = json.dumps(update.to_dict(), ensure_ascii=False).encode('utf-8') + b'\n'
+        writer = self.writers[index]
+        if writer is None:
+            self.pending[index].append(line)
+            return
+        writer.write(line)
+        await writer.drain()
+
+    async def stop(self):
+        if self.monitor_task is not None:
+            self.monitor_task.cancel()
+        for writer in self.writers:
+            if writer is not None:
+                writer.close()
+        self.server.close()
+        # Обработчики завершаются сами, когда соединение закрыто
+        for process in self.processes:
+            await asyncio.to_thread(process.join, 10)
+            if process.is_alive():
+                process.kill()
+
+
+def run(build, token: str, workers: int = SHARD_WORKERS):
+    """Прием обновлений в этом процессе, обработка - в workers процессах"""
+    router = ShardRouter(build, token, workers)
+
+    async def startup(application: Application):
+        await router.start()
+
+    async def shutdown(application: Application):
+        await router.stop()
+
+    application = (
+        Application.builder()
+        .token(token)
+        .request(telegram_request(os.getenv('PROXY_URL')))
+        .concurrent_updates(False)
+        .post_init(startup)
+        .post_shutdown(shutdown)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, router.dispatch))
+    logger.info("Шардирование: %d обработчиков", workers)
+
+    # Подписываемся на те же обновления, что обрабатывают обработчики
+    updates = launcher.allowed_updates(build(token))
+    launcher.run(application, updates=updates)
@@ -0,0 +1,100 @@
+import os
+import time
+import asyncio
+import logging
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from outbox import MAX_MESSAGE_LENGTH, retry_seconds, split_message
+from resilience import time_left
+
+logger = logging.getLogger(__name__)
+
+# Потоковый вывод ответов (редактирование сообщения по мере генерации)
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+
+# Не чаще одного редактирования в STREAM_EDIT_INTERVAL секунд
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+
+# Минимум новых символов для промежуточного редактирования
+STREAM_EDIT_MIN_CHARS = int(os.getenv('STREAM_EDIT_MIN_CHARS', '40'))
+
+# Попыток финального редактирования, затем ответ уходит новым сообщением
+FINAL_EDIT_ATTEMPTS = 3
+
+CURSOR = " ▌"
+
+
+async def _edit(message, text: str) -> float:
+    """Редактирование сообщения, возвращает паузу от Telegram (0 если успешно)"""
+    try:
+        await message.edit_text(text)
+    except RetryAfter as e:
+        return retry_seconds(e)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            raise
+    return 0.0
+
+
+async def stream_to_message(message, chunks) -> str:
+    """Выводит поток текста в сообщение-заглушку, возвращает полный ответ
+
+    Редактирования объединяются: промежуточное обновление отправляется не
+    чаще STREAM_EDIT_INTERVAL и только если набралось STREAM_EDIT_MIN_CHARS
+    новых символов. Первое обновление уходит сразу, как только есть текст.
+    """
+    text = ""
+    shown = 0
+    next_edit = 0.0
+    blocked_until = 0.0
+
+    async for chunk in chunks:
+        text += chunk
+        needed = STREAM_EDIT_MIN_CHARS if shown else 1
+        if time.monotonic() < next_edit or len(text) - shown < needed or not text.strip():
+            continue
+        if len(text) + len(CURSOR) > MAX_MESSAGE_LENGTH:
+            # Остаток будет отправлен после завершения генерации
+            continue
+
+        pause = await _edit(message, text + CURSOR)
+        if pause:
+            blocked_until = time.monotonic() + pause
+        else:
+            shown = len(text)
+        next_edit = time.monotonic() + max(STREAM_EDIT_INTERVAL, pause)
+
+    display = text if text.strip() else "⚠️ Пустой ответ от AI"
+
+    # Финальное редактирование обязательно - ждем, если Telegram просит паузу,
+    # но не дольше FINAL_EDIT_ATTEMPTS попыток и дедлайна запроса
+    first, *rest = split_message(display)
+    pause = max(0.0, blocked_until - time.monotonic())
+    edited = False
+    for _ in range(FINAL_EDIT_ATTEMPTS):
+        left = time_left()
+        if left is not None and pause >= left:
+            break
+        if pause:
+            await asyncio.sleep(pause)
+        try:
+            pause = await _edit(message, first)
+        except NetworkError as e:
+            # BadRequest - тоже NetworkError, но повтор его не исправит
+            if isinstance(e, BadRequest):
+                raise
+            logger.info("Ошибка сети при редактировании: %s", e)
+            pause = STREAM_EDIT_INTERVAL
+            continue
+        if not pause:
+            edited = True
+            break
+        logger.info("Telegram просит паузу %.1f c перед редактированием", pause)
+    if not edited:
+        # Сообщение-заглушку обновить не удалось - ответ отдельным сообщением
+        await message.reply_text(first)
+
+    # Остаток длинного ответа - отдельными сообщениями по границам абзацев
+    for part in rest:
+        await message.reply_text(part)
+
+    return text
@@ -0,0 +1,88 @@
+import os
+import re
+from collections import namedtuple
+from chat_history import estimate_tokens
+from metrics import AI_TIERS
+from translation import TRANSLATE_TOKENS_PER_TARGET
+
+# Простые запросы идут к быстрой модели провайдера (0 - всегда основная модель)
+AI_TIERING = os.getenv('AI_TIERING', '1') == '1'
+
+# Запрос длиннее (символы) считается сложным в чате и переводе
+TIER_FAST_MAX_CHARS = int(os.getenv('TIER_FAST_MAX_CHARS', '300'))
+
+# Текст длиннее (токены) резюмирует основная модель
+TIER_FAST_SUMMARY_TOKENS = int(os.getenv('TIER_FAST_SUMMARY_TOKENS', '1000'))
+
+# Сколько последних сообщений истории проверяется на код и формулы
+CONTEXT_MESSAGES = 4
+
+# fast - быстрая модель, max_tokens - лимит под ожидаемый размер ответа
+Tier = namedtuple('Tier', 'fast max_tokens')
+
+CODE = re.compile(
+    r'```|`[^`\n]+`|=>|->|[{};]\s*$|^\s*(?:def|class|import|from|function|const|let|var|return|'
+    r'public|private|#include|SELECT|INSERT|UPDATE)\b|\w+\([^()\n]*\)\s*[{:]',
+    re.M
+)
+MATH = re.compile(r'\d\s*[-+*/^=<>]\s*\(?\d|[∑∫√π≤≥≠∞]|\\(?:frac|sum|int|sqrt)|\b(?:sin|cos|log|lim)\b')
+
+# Слова, после которых ждут подробного ответа
+COMPLEX = re.compile(
+    r'\b(?:почему|объясн|сравн|докаж|разбер|проанализ|напиши|реализ|спроектир|алгоритм|пошагов|'
+    r'подробн|explain|why|compare|prove|implement|write)',
+    re.I
+)
+
+
+def _tier(fast: bool, max_tokens: int) -> Tier:
+    return Tier(fast and AI_TIERING, max_tokens)
+
+
+def count_tier(mode: str, tier: Tier):
+    """Учет выбранной модели - только для запросов, которые действительно идут к AI"""
+    AI_TIERS.inc(mode=mode, tier='fast' if tier.fast else 'main')
+
+
+def counted(mode: str, tier: Tier, call):
+    """Фабрика для кэша ответов: модель учитывается при вызове, а не при попадании в кэш"""
+    async def run():
+        count_tier(mode, tier)
+        return await call()
+    return run
+
+
+def is_technical(text: str) -> bool:
+    """Код или формулы - такие вопросы всегда решает основная модель"""
+    return bool(CODE.search(text) or MATH.search(text))
+
+
+def chat_tier(messages: list) -> Tier:
+    """Модель и лимит ответа для чата по последнему вопросу и свежей истории"""
+    question = messages[-1]['content']
+    context = [m['content'] for m in messages[-CONTEXT_MESSAGES - 1:-1]]
+    if is_technical(question) or any(is_technical(text) for text in context):
+        return _tier(False, 1500)
+    if COMPLEX.search(question) or len(question) > TIER_FAST_MAX_CHARS:
+        return _tier(False, 1000)
+    # Приветствия и короткие вопросы - короткий ответ
+    return _tier(True, 500)
+
+
+def translate_tier(targets: list, text: str) -> Tier:
+    """Лимит по длине текста (перевод ~ в 2 раза длиннее в токенах), быстрая модель - для коротких"""
+    per_target = min(TRANSLATE_TOKENS_PER_TARGET, estimate_tokens(text) * 2 + 50)
+    fast = len(text) <= TIER_FAST_MAX_CHARS and len(targets) <= 1 and not is_technical(text)
+    return _tier(fast, per_target * max(1, len(targets)))
+
+
+def summary_tier(text: str) -> Tier:
+    """Короткий текст - короткое резюме от быстрой модели"""
+    tokens = estimate_tokens(text)
+    return _tier(tokens <= TIER_FAST_SUMMARY_TOKENS, 200 if tokens <= 300 else 500)
+
+
+def ideas_tier(topic: str) -> Tier:
+    """Короткая простая тема - быстрой модели, лимит под пять идей"""
+    fast = len(topic) <= TIER_FAST_MAX_CHARS and not is_technical(topic) and not COMPLEX.search(topic)
+    return _tier(fast, 800)
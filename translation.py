@@ -0,0 +1,154 @@
+import os
+import re
+import json
+import logging
+from language_id import SURE_MARGIN, detect_language, has_words
+
+logger = logging.getLogger(__name__)
+
+# Сколько языков можно указать в одном запросе
+TRANSLATE_MAX_TARGETS = int(os.getenv('TRANSLATE_MAX_TARGETS', '5'))
+
+# Лимит токенов ответа на один язык
+TRANSLATE_TOKENS_PER_TARGET = int(os.getenv('TRANSLATE_TOKENS_PER_TARGET', '500'))
+
+# Названия языков и их сокращения -> название для запроса
+LANGUAGES = {
+    'английский': ('англ', 'en', 'eng', 'english'),
+    'немецкий': ('нем', 'de', 'german', 'deutsch'),
+    'французский': ('франц', 'фр', 'fr', 'french'),
+    'испанский': ('исп', 'es', 'spanish'),
+    'итальянский': ('итал', 'it', 'italian'),
+    'португальский': ('порт', 'pt', 'portuguese'),
+    'китайский': ('кит', 'zh', 'chinese'),
+    'японский': ('яп', 'ja', 'japanese'),
+    'корейский': ('кор', 'ko', 'korean'),
+    'арабский': ('ar', 'arabic'),
+    'турецкий': ('тур', 'tr', 'turkish'),
+    'польский': ('пол', 'pl', 'polish'),
+    'украинский': ('укр', 'uk', 'ukrainian'),
+    'белорусский': ('бел', 'be', 'belarusian'),
+    'казахский': ('каз', 'kk', 'kazakh'),
+    'русский': ('рус', 'ru', 'russian'),
+    'хинди': ('hi', 'hindi'),
+    'болгарский': ('болг', 'bg', 'bulgarian'),
+    'сербский': ('серб', 'sr', 'serbian'),
+    'македонский': ('макед', 'mk', 'macedonian'),
+    'чешский': ('чеш', 'cs', 'czech'),
+    'нидерландский': ('голландский', 'nl', 'dutch'),
+    'шведский': ('швед', 'sv', 'swedish'),
+    'финский': ('фин', 'fi', 'finnish'),
+    'греческий': ('греч', 'el', 'greek'),
+    'эстонский': ('эст', 'et', 'estonian'),
+    'латышский': ('лат', 'lv', 'latvian'),
+    'литовский': ('лит', 'lt', 'lithuanian'),
+    'грузинский': ('груз', 'ka', 'georgian'),
+    'армянский': ('арм', 'hy', 'armenian'),
+    'узбекский': ('узб', 'uz', 'uzbek'),
+    'иврит': ('he', 'hebrew'),
+    'вьетнамский': ('вьет', 'vi', 'vietnamese'),
+}
+ALIASES = {alias: name for name, aliases in LANGUAGES.items() for alias in (name,) + aliases}
+
+# Коды из двух букв ("uk", "de", "фр") совпадают с обычными префиксами сообщений
+# ("UK: новости") - языком они считаются только в явной форме: "на uk: текст"
+SHORT_ALIAS = 2
+
+TARGET_SEPARATORS = re.compile(r'\s*(?:,|;|/|\+|\bи\b)\s*')
+
+
+def _language(word: str, explicit: bool = False):
+    """Название языка для запроса или None, если это не язык"""
+    word = ' '.join(word.lower().split())
+    word, prefixed = re.subn(r'^на\s+', '', word)
+    word, suffixed = re.subn(r'\s+язык$', '', word)
+    explicit = explicit or bool(prefixed or suffixed)
+    if word in ALIASES and (explicit or len(word) > SHORT_ALIAS):
+        return ALIASES[word]
+    return None
+
+
+def parse_request(message: str):
+    """Разбор "язык1, язык2: текст" -> ([языки], текст)
+
+    Если перед двоеточием не языки - весь текст переводится,
+    а язык выбирает модель (список языков пустой).
+    """
+    prefix, sep, text = message.partition(':')
+    if not sep or not text.strip() or len(prefix) > 100:
+        return [], message.strip()
+
+    targets = []
+    # "на en, de: текст" - "на" относится ко всему списку
+    explicit = bool(re.match(r'на\s', prefix.strip().lower()))
+    for part in TARGET_SEPARATORS.split(prefix.strip()):
+        if not part:
+            continue
+        language = _language(part, explicit)
+        if language is None:
+            return [], message.strip()
+        if language not in targets:
+            targets.append(language)
+    return targets[:TRANSLATE_MAX_TARGETS], text.strip()
+
+
+def plan_translation(message: str):
+    """Разбор запроса и локальное определение языка текста
+
+    Возвращает (языки для AI, текст, язык текста, готовые переводы без AI).
+    None в списке языков - язык перевода выбирает модель.
+    """
+    targets, text = parse_request(message)
+    if not has_words(text):
+        # Числа, ссылки, эмодзи - переводить нечего
+        return [], text, None, [(None, text)]
+
+    # Ошибка здесь дорога (текст вернется без перевода или с неверной подсказкой
+    # языка) - сомнительный язык не используем, его определит модель
+    source = detect_language(text, SURE_MARGIN)
+    if not targets:
+        if source is None:
+            return [None], text, None, []
+        targets = ['английский' if source == 'русский' else 'русский']
+
+    # Текст уже на нужном языке - к AI не обращаемся
+    local = [(target, text) for target in targets if target == source]
+    return [target for target in targets if target != source], text, source, local
+
+
+def _genitive(language: str) -> str:
+    """"английский" -> "английского" """
+    return language[:-2] + 'ого' if language.endswith('ий') else language
+
+
+def build_prompt(targets: list, text: str, source: str = None) -> str:
+    """Один запрос к AI на все языки сразу (известный язык текста сокращает инструкцию)"""
+    if not targets or targets == [None]:
+        return (f"Определи язык текста и переведи его: на русский, а если он уже на русском - "
+                f"на английский. Ответь только переводом.\n\n{text}")
+    origin = f" с {_genitive(source)}" if source else ""
+    if len(targets) == 1:
+        return f"Переведи{origin} на {targets[0]}. Только перевод.\n\n{text}"
+    example = ', '.join(f'"{target}": "..."' for target in targets)
+    return (f"Переведи{origin} на языки: {', '.join(targets)}. "
+            f"Ответь только JSON объектом вида {{{example}}} без пояснений и разметки.\n\n{text}")
+
+
+def split_translations(targets: list, answer: str) -> list:
+    """Ответ AI -> [(язык, перевод)]; если JSON не разобрать - ответ целиком"""
+    if len(targets) <= 1:
+        return [(targets[0] if targets else None, answer.strip())]
+
+    start, end = answer.find('{'), answer.rfind('}')
+    try:
+        data = json.loads(answer[start:end + 1]) if start != -1 and end > start else None
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        logger.warning("Ответ с переводами не в формате JSON - отправляем целиком")
+        return [(None, answer.strip())]
+
+    # Модель может назвать язык по-своему ("English" вместо "английский")
+    found = {_language(str(key)) or str(key).strip().lower(): str(value).strip() for key, value in data.items()}
+    translations = [(target, found[target]) for target in targets if found.get(target)]
+    return translations or [(None, answer.strip())]
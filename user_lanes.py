@@ -0,0 +1,95 @@
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from scheduler import USER_MAX_QUEUED, RateLimited
+
+logger = logging.getLogger(__name__)
+
+# Режимы, где новое сообщение отменяет ответ на предыдущее (пусто - сообщения ждут очереди)
+CANCEL_ON_NEW_MESSAGE = {
+    mode.strip() for mode in os.getenv('CANCEL_ON_NEW_MESSAGE', 'chat').split(',') if mode.strip()
+}
+
+
+class Superseded(Exception):
+    """Запрос отменен: новое сообщение, смена режима или /clear"""
+
+
+class LaneEntry:
+    """Сообщение в очереди пользователя: задача-обработчик и признак завершения"""
+
+    __slots__ = ('task', 'finished', 'superseded')
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.finished = asyncio.Event()
+        self.superseded = False
+
+
+class UserLanes:
+    """Сообщения одного пользователя обрабатываются по очереди
+
+    Два быстрых сообщения не меняют историю одновременно. Отмена
+    прерывает обработчики пользователя вместе с запросами к AI: в них
+    поднимается Superseded, ответ пользователю не отправляется.
+    """
+
+    def __init__(self, max_waiting: int = USER_MAX_QUEUED):
+        self.max_waiting = max_waiting
+        self.lanes = {}
+        self.cancelled = 0
+
+    @asynccontextmanager
+    async def lane(self, user_id: int, supersede: bool = False):
+        """Очередь пользователя; supersede - отменить его предыдущие сообщения"""
+        if supersede:
+            self.cancel(user_id)
+        lane = self.lanes.setdefault(user_id, [])
+        if len(lane) > self.max_waiting:
+            raise RateLimited("Дождитесь ответа на предыдущие запросы")
+
+        entry = LaneEntry(asyncio.current_task())
+        earlier = list(lane)
+        lane.append(entry)
+        try:
+            # Ждем все более ранние: отмененное в очереди сообщение завершается раньше предшественников
+            for previous in earlier:
+                await previous.finished.wait()
+            yield
+        except asyncio.CancelledError:
+            if not entry.superseded:
+                raise
+            # Отмену вызвали мы, а не остановка бота - задача продолжает работу
+            if hasattr(entry.task, 'uncancel'):
+                entry.task.uncancel()
+            raise Superseded("Запрос отменен") from None
+        finally:
+            entry.finished.set()
+            lane.remove(entry)
+            if not lane and self.lanes.get(user_id) is lane:
+                del self.lanes[user_id]
+
+    def active(self, user_id: int) -> bool:
+        """Обрабатываются ли сейчас сообщения пользователя"""
+        return user_id in self.lanes
+
+    def cancel(self, user_id: int) -> int:
+        """Отмена текущего и ожидающих сообщений пользователя"""
+        count = 0
+        for entry in self.lanes.get(user_id, ()):
+            if not entry.superseded:
+                entry.superseded = True
+                entry.task.cancel()
+                count += 1
+        if count:
+            self.cancelled += count
+            logger.info("Отменено запросов пользователя %s: %d", user_id, count)
+        return count
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self.lanes),
+            'pending': sum(len(lane) for lane in self.lanes.values()),
+            'cancelled': self.cancelled,
+        }
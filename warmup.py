@@ -0,0 +1,58 @@
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать прогрева одного соединения (секунды), 0 - не прогревать
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', '5'))
+
+
+class StartupTimer:
+    """Время этапов запуска для лога"""
+
+    def __init__(self, started: float = None):
+        self.started = started if started is not None else time.perf_counter()
+        self.last = self.started
+        self.phases = []
+
+    def mark(self, phase: str):
+        """Завершение этапа phase (время с предыдущей отметки)"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def summary(self) -> str:
+        parts = ', '.join(f"{phase} {seconds:.2f} с" for phase, seconds in self.phases)
+        return f"Запуск за {self.last - self.started:.2f} с: {parts}"
+
+
+async def _telegram(bot, timeout: float):
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(bot.get_me(), timeout)
+    except Exception as e:
+        return time.monotonic() - started, f"{type(e).__name__}: {e}"
+    return time.monotonic() - started, 200
+
+
+async def warm_up(engine, bot, timeout: float = WARMUP_TIMEOUT) -> dict:
+    """Параллельное открытие соединений с AI провайдерами и Telegram до начала работы
+
+    Соединения остаются в пулах, поэтому первое сообщение пользователя
+    не ждет TLS рукопожатия. Недоступные провайдеры отмечаются ошибкой.
+    """
+    if timeout <= 0:
+        return {}
+    providers, telegram = await asyncio.gather(engine.warm_up(timeout), _telegram(bot, timeout))
+    results = {**providers, 'telegram': telegram}
+    for name, (seconds, status) in results.items():
+        if status in (401, 403):
+            logger.warning("Прогрев %s: ключ API не принят (HTTP %s)", name, status)
+        elif isinstance(status, int):
+            # Любой HTTP ответ - соединение открыто и осталось в пуле
+            logger.info("Прогрев %s: %.2f с", name, seconds)
+        else:
+            logger.warning("Прогрев %s: %s", name, status)
+    return results